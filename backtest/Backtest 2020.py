@@ -2,9 +2,17 @@ from pandas import *
 import pandas as pd
 from datetime import *
 import time
+import os
 import numpy as np
-from itertools import product
 from IPython.display import display
+from backtest_engine import evaluateGrid, evaluateDeduplicated, evaluateLeaderboard, evaluateTotals, \
+    evaluateWithStats, evaluateSizeSweep, evaluateWeighted, FrameResults, FrameTotals, FrameStats, Leaderboard, decodeFrame, \
+    loadTotals, riskFreeTable, meanRiskFree, sectorAverage, rankArrays
+from backtest_data import buildPanel, loadCached, readRangesExcel, ingestStreaming, openShards, shardRangePlan, cacheLayout, \
+    sectorManifest, manifestPanel, changedPartitions
+from backtest_runner import runSectorsParallel, evaluateSharded
+from backtest_ranges import cachedRangePlan
+from backtest_output import BackgroundWriter, periodTable, portfolioTable
 
 metrics = [ 'PE_RATIO', 'PX_TO_BOOK_RATIO', 'TRAIL_12M_EPS', 'TOT_DEBT_TO_TOT_EQY', 'PX_TO_FREE_CASH_FLOW', 'RETURN_COM_EQY', 'RETURN_ON_ASSET' ]
 
@@ -16,127 +24,429 @@ hvhs_metrics = [ 'TRAIL_12M_EPS', 'PRICE_TO_FCF', 'RETURN_COM_EQY', 'RETURN_ON_A
 
 pd.options.mode.chained_assignment = None
 
-totalDF = read_csv("Backtest VALUES 2020.csv",index_col='DATE',parse_dates=True)
+startDate = to_datetime('2015-09-01')
 
-totalDF = totalDF.sort_index()
+#For exports too large to load at once, set streamIngest = True: the CSV is read ingestChunkRows rows
+#at a time into memory-mapped shards ("Backtest VALUES 2020.shards") and the panel is opened from them.
+#The range plan is built from every row of the export while it is read and kept with the shards, so
+#both ways of loading give the same ranges.
+streamIngest = False
+ingestChunkRows = 1000000
 
-totalDF.dropna(axis='index',how='any',inplace=True)
+if streamIngest:
+    shardDir = ingestStreaming("Backtest VALUES 2020.csv", "Backtest VALUES 2020.shards", startDate, ingestChunkRows)
+    panel = openShards(shardDir)
+    datesList = list(panel.dates)
+    sectors = np.array(panel.sectors, dtype=object)
+    rangePlan = shardRangePlan(shardDir)
+else:
+    #The CSV is parsed once into a binary cache ("Backtest VALUES 2020.csv.cache") and read from there
+    #on later runs until the file changes
+    rawDF = loadCached("Backtest VALUES 2020.csv")
 
-startDate = to_datetime('2015-09-01')
-startDate=startDate.toordinal()
+    totalDF = rawDF.sort_index(kind='mergesort')
+
+    totalDF = totalDF.dropna(axis='index',how='any')
+
+    totalDF = totalDF.loc[totalDF.index>=startDate]
 
-totalDF['ordinalTime']=totalDF.index
-totalDF['ordinalTime'] = totalDF['ordinalTime'].apply(date.toordinal)
-totalDF = totalDF.loc[totalDF['ordinalTime']>=startDate]
+    datesList = sorted(set(totalDF.index))
+    sectors = totalDF.GICS_SECTOR_NAME.unique()
 
-datesList = sorted(set(totalDF.index))
-sectors = totalDF.GICS_SECTOR_NAME.unique()
+    panel = buildPanel(totalDF, datesList)
 
-totalDF_ranges = pd.read_excel("Backtest VALUES 2020.xlsx", index_col=[0,1])
-totalDF_ranges = totalDF_ranges.sort_index()
-totalDF_ranges.groupby('GICS_SECTOR_NAME').nunique()
+    #Range percentiles use every date of the export indexed by (date, sector), taken from the same cache as
+    #totalDF.  Set rangesFromExcel = True to use "Backtest VALUES 2020.xlsx" instead (also cached).
+    rangesFromExcel = False
+    if rangesFromExcel:
+        totalDF_ranges = loadCached("Backtest VALUES 2020.xlsx", readRangesExcel)
+    else:
+        totalDF_ranges = rawDF.set_index('GICS_SECTOR_NAME', append=True)
+
+    #Every percentile of every (sector, metric) is computed once into a range plan, saved next to the data
+    #("Backtest VALUES 2020.ranges.npz") and rebuilt only when the source of the ranges or the cache layout
+    #(metricDtype and the columns read) changes.
+    rangesSource = "Backtest VALUES 2020.xlsx" if rangesFromExcel else "Backtest VALUES 2020.csv"
+    rangesKey = repr((rangesSource, os.path.getsize(rangesSource), os.path.getmtime(rangesSource), cacheLayout()))
+    rangePlan = cachedRangePlan("Backtest VALUES 2020.ranges.npz", rangesKey, totalDF_ranges)
+
+    #Only the panel and the range plan are used from here on, so the loaded frames are let go
+    del rawDF, totalDF, totalDF_ranges
 
 def getNormal(metric, step):
-    return range(int(round(np.percentile(totalDF_ranges.loc[(slice(None), sector), metric].dropna(), 34))),                      int(round(np.percentile(totalDF_ranges.loc[(slice(None), sector), metric].dropna(), 68))), step)
+    return rangePlan.range(sector, metric, step, 34, 68)
+
+#Metric and threshold step of each range, in frame order
+rangeSteps = [('PE_RATIO', 2), ('PX_TO_BOOK_RATIO', 1), ('TRAIL_12M_EPS', 2), ('TOT_DEBT_TO_TOT_EQY', 10), \
+              ('TOT_DEBT_TO_TOT_EQY', 5), ('RETURN_COM_EQY', 2), ('RETURN_ON_ASSET', 2)]
+
+#'absolute' tests each metric against a value as above.  'percentile' tests whether a company is in the
+#best p% of its sector on the date for that metric (see backtest_engine.rankArrays); the grid is then
+#percentileRanges, whole percentiles in frame order, the same for every sector, and the budget is not used.
+thresholdMode = 'absolute'
+percentileRanges = [range(10, 60, 10)] * 7
+
+#The engine's arrays of a sector: its metric values, or their per-date percentile ranks in percentile mode
+def sectorArrays(panel, sector, datePositions=None):
+    arrays = panel.sectorArrays(sector, datePositions)
+    return rankArrays(arrays) if thresholdMode == 'percentile' else arrays
+
+#Grid budget.  With both set to None every sector uses the steps in rangeSteps, however many frames
+#that makes.  gridBudget caps the frames of a sector and timeBudget its run time in seconds (converted
+#to frames with a short timed probe of the sector); the thresholds are then spread over each metric's
+#34th-68th percentile band within the budget, in equal steps or at percentiles (gridSpacing).
+gridBudget = None
+timeBudget = None
+gridSpacing = 'steps'
+probeFrames = 4096
+
+#Frames a sector may run under the budget, or None if there is no budget
+def frameBudget():
+    budget = gridBudget
+    if timeBudget is not None:
+        probe = rangePlan.budgetGrid(sector, [m for m, step in rangeSteps], probeFrames, gridSpacing)
+        arrays = sectorArrays(panel, sector)
+        t = time.time()
+        evaluateGrid(arrays, probe)
+        framesPerSecond = np.prod([len(r) for r in probe]) / max(time.time() - t, 1e-6)
+        budget = min(budget or np.inf, int(timeBudget * framesPerSecond))
+    return budget
+
+#Grid of every sector worked out so far, so the grid reported before a run is the grid that runs
+sectorGrids = {}
 
 def getRanges():
     global peRange, pbRange, epsRange, deRange, fcfRange, roeRange, roaRange
     
-    peRange =  getNormal('PE_RATIO', 2)
-    pbRange =  getNormal('PX_TO_BOOK_RATIO', 1)
-    epsRange =  getNormal('TRAIL_12M_EPS', 2)
-    deRange =  getNormal('TOT_DEBT_TO_TOT_EQY', 10)
-    fcfRange =  getNormal('TOT_DEBT_TO_TOT_EQY', 5)
-    roeRange =  getNormal('RETURN_COM_EQY', 2)
-    roaRange =  getNormal('RETURN_ON_ASSET', 2)
+    if sector not in sectorGrids:
+        saved = loadTotals(totalsName(), sector) if incrementalUpdate else None
+        budget = frameBudget() if saved is None and thresholdMode == 'absolute' else None
+        if saved is not None:
+            sectorGrids[sector] = saved[1]
+        elif thresholdMode == 'percentile':
+            sectorGrids[sector] = [list(r) for r in percentileRanges]
+        elif budget is None:
+            sectorGrids[sector] = [getNormal(metric, step) for metric, step in rangeSteps]
+        else:
+            sectorGrids[sector] = rangePlan.budgetGrid(sector, [m for m, step in rangeSteps], budget, gridSpacing)
+    peRange, pbRange, epsRange, deRange, fcfRange, roeRange, roaRange = sectorGrids[sector]
 
 now = time.strftime("d%dm%my%Y")
+
+#How often prod() saves its progress, in seconds
+checkpointSeconds = 600
+
+#Running totals of every frame (see backtest_engine.FrameTotals) are saved in totalsName() with the
+#grid and a manifest of the sector's data (see backtest_data.sectorManifest).  With incrementalUpdate
+#a sector keeps its saved grid and only the (sector, date) partitions that are new, restated or gone
+#since are scored: restated and dropped dates have their old totals taken out, and new and restated
+#dates have their totals added.  It applies to prodFast runs without the per-period and
+#per-portfolio sheets.
+incrementalUpdate = False
+
+def totalsName():
+    return "results/"+sector+("PercentileTotals.npz" if thresholdMode == 'percentile' else "Totals.npz")
+
+#Totals of the sector over every date, scoring only the partitions that changed since the saved totals
+def updateTotals():
+    saved = loadTotals(totalsName(), sector)
+    if saved is not None and saved[1] == [list(r) for r in gridRanges]:
+        totals, ranges, manifest = saved
+        stale, fresh = changedPartitions(manifest, panel, sector)
+        if stale:
+            totals.remove(evaluateTotals(sectorArrays(manifestPanel(manifest, sector), sector, stale), gridRanges))
+    else:
+        totals = FrameTotals(int(np.prod([len(r) for r in gridRanges])))
+        stale, fresh = [], list(range(len(panel.dates)))
+    if fresh:
+        totals.merge(evaluateTotals(sectorArrays(panel, sector, fresh), gridRanges))
+    if stale or fresh:
+        totals.save(totalsName(), sector, gridRanges, sectorManifest(panel, sector))
+    print(sector, 'dates removed:', len(stale), 'dates scored:', len(fresh), 'of', len(panel.dates))
+    return totals
+
+#Portfolio sizes to sweep.  None keeps the top-5 portfolio.  With a list such as [3, 5, 10, 15], prodFast
+#takes the best max(sizes) companies of each (frame, date) once and every size from prefix sums of their
+#ranking, so dfTotalPort has a row per (frame, size), labelled <frame>_N<size>, in one pass over the
+#grid (a few times the cost of a top-5 run rather than one run per size).  It applies to prodFast runs
+#that record every frame without the per-period and per-portfolio sheets, and cannot be combined with
+#incrementalUpdate, whose saved totals are of the top-5 portfolio.
+portfolioSizes = None
+
+#Metric weights of the hsf score.  None counts the tests passed, as before.  A weight vector (one weight
+#per metric, in the order of metrics) or a list of weight sets (backtest_engine.weightGrid builds every
+#combination of candidate weights) scores every frame under every set with one matrix product per block, and
+#dfTotalPort has a row per (frame, weight set), labelled <frame>_W<set>, with the weights in columns.
+#Combined with portfolioSizes, every size is taken for every weight set.  Like portfolioSizes it applies to
+#prodFast runs that record every frame without the per-period and per-portfolio sheets, and cannot be
+#combined with incrementalUpdate, whose saved totals are of the unweighted hsf score.
+scoreWeights = None
+weightColumns = [t.replace('Score', 'Weight') for t in dfScores]
+
+#Adds the FrameStats columns to dfTotalPort in prodFast runs that record every frame
+extendedStats = True
+
+#With leaderboardSize = None the TotalPortfolio sheet lists every frame.  Otherwise only the best
+#leaderboardSize frames by leaderboardObjective ('totalTreynor' or 'meanReturn') are kept while the
+#grid is scored and written out; the rest are only counted, with a histogram of the objective over
+#leaderboardEdges if it is set.
+leaderboardSize = None
+leaderboardObjective = 'totalTreynor'
+leaderboardEdges = None
+
+#'csv' appends to the IndPortPeriod and _PortfolioAvgsPerPeriod CSV sheets as before.  'npz' (or
+#'parquet' with pyarrow installed) writes them as compressed columnar chunks under outputDirectory(),
+#which backtest_output.loadResults reads back.  Either way the files are written by resultsWriter's
+#background thread while scoring carries on.
+outputFormat = 'npz'
+
+#Every output file is named after the sector being run, so parallel sector workers never share a file
+def outputName(kind):
+    return "results/"+sector+kind+now+".csv"
+
+def outputDirectory():
+    return "results/"+sector+now
+
 def outputIndPeriod(portfolioDF, date):
-        portfolioDF.to_csv("results/"+sector+"IndPortPeriod"+now+".csv", mode='a')
+    if outputFormat == 'csv':
+        resultsWriter.appendCSV(outputName("IndPortPeriod"), portfolioDF)
+    else:
+        portfolioDF['hsfScore'] = portfolioDF['hsfScore'].astype(np.int8)
+        portfolioDF['frameId'] = currentFrameId
+        resultsWriter.append("IndPortPeriod", portfolioDF)
         
 def outputIndPort(portSummaryDF, frame):
-    portSummaryDF.to_csv("results/"+sector+"_PortfolioAvgsPerPeriod"+now+".csv",                   mode='a',index_label=("T"+str(frame[0])+str(frame[1])+str(frame[2])+str(frame[3])                        +str(frame[4])+str(frame[5])+str(frame[6])))
+    if outputFormat == 'csv':
+        #portSummaryDF is refilled by the next frame while the writer thread may still be on this one
+        resultsWriter.appendCSV(outputName("_PortfolioAvgsPerPeriod"), portSummaryDF.copy(), index_label=createIdentifier(frame))
+    else:
+        summary = portSummaryDF.rename_axis('DATE').astype({c: np.float64 for c in portSummaryDF.columns if c != 'ind'})
+        summary['frameId'] = currentFrameId
+        resultsWriter.append("PortfolioAvgsPerPeriod", summary)
 
 def outputTotalPort(dfTotalPort, frame):
-    dfTotalPort.to_csv("results/"+sector+"TotalPortfolio"+now+".csv", mode='w',index_label=("T"+"Portfolio"))
+    dfTotalPort.to_csv(outputName("TotalPortfolio"), mode='w',index_label=("T"+"Portfolio"))
     
+#A checkpoint has no date stamp so that a run restarted on another day still finds it
+def checkpointName():
+    return "results/"+sector+"Checkpoint.npz"
+
+#Identifies the data and ranges of a run; a checkpoint is only resumed when this matches
+def checkpointKey():
+    return sector + "|" + thresholdMode + "|" + panel.fingerprint(sector) + "|" + repr(frameResults.ranges)
+
 def createIdentifier(frame):
-    name = "T"
-    for p in frame:
-        name+=str(p)
-    return name
+    return "T" + "_".join(str(p) for p in frame)
 
 def calculatePortLoop(dateList, frame, identity):
     
     for date in datesList:
         
-        portfolioDF = sectorDF.loc[sectorDF.index==date]
+        portfolioDF = panel.blockFrame(sector, date)
         
         for x in range(7):
             portfolioDF[dfTests[x]] = frame[x]
         
         for x in range(7):
-            if metrics[x] in lvhs_metrics:
+            if thresholdMode == 'percentile':
+                better = portfolioDF[metrics[x]].rank(method='min', ascending=metrics[x] in lvhs_metrics) - 1
+                portfolioDF[dfScores[x]] = 100 * better // len(portfolioDF) < frame[x]
+            elif metrics[x] in lvhs_metrics:
                 portfolioDF[dfScores[x]] = portfolioDF[metrics[x]] < frame[x]
             else:
                 portfolioDF[dfScores[x]] = portfolioDF[metrics[x]] > frame[x]
         
         portfolioDF['betaScore']=1/(portfolioDF['ADJUSTED_BETA']*1000)
-        portfolioDF['hsfScore'] = None
+        num=0
         for x in range(7):
-            portfolioDF['hsfScore']=portfolioDF['hsfScore']+portfolioDF[dfScores[x]].astype(int)
+            num = num + portfolioDF[dfScores[x]].astype(int)
+        portfolioDF['hsfScore'] = num
             
         portfolioDF['ind'] = identity
         
-        portfolioDF.sort_values(by='hsfScore',ascending=False,inplace=True)
+        portfolioDF.sort_values(by='hsfScore',ascending=False,inplace=True,kind='mergesort')
         portfolioDF=portfolioDF.iloc[0:5]
         
         if iperiods:
             outputIndPeriod(portfolioDF, date)
         
         for t in dfTests:
-            portSummaryDF.loc[portSummaryDF.index==date, t] = portfolioDF.ix[0, t]
+            if not portfolioDF.empty:
+                portSummaryDF.loc[portSummaryDF.index==date, t] = portfolioDF[t].iloc[0]
         
         portSummaryDF.loc[portSummaryDF.index==date,'maxHSFScore'] = portfolioDF['hsfScore'].max()
         portSummaryDF.loc[portSummaryDF.index==date,'return'] = (portfolioDF['RETURN'].mean())
         portSummaryDF.loc[portSummaryDF.index==date,'beta'] = (portfolioDF['ADJUSTED_BETA'].mean()+0.0000001)
 
-    portSummaryDF['treynor']=(portSummaryDF['return']-TBill3Mth)/portSummaryDF['beta']
+    portSummaryDF['treynor']=(portSummaryDF['return']-portSummaryDF['tBill3Mth'])/portSummaryDF['beta']
     portSummaryDF['ind'] = identity
 
     return portSummaryDF
 
+#Results are checkpointed every checkpointSeconds, and a restarted run with the same data and ranges
+#continues from the first frame that was not finished.  Sheets written with IndPortfolios/IndPeriods
+#are appended to, so a resumed run may repeat the frame that was running when it stopped.
 def prod():
     
-    for frame in product(peRange, pbRange, epsRange, deRange, fcfRange, roeRange, roaRange):
+    frameResults.loadCheckpoint(checkpointName(), checkpointKey())
+    lastCheckpoint = time.time()
+    
+    for frameId in range(frameResults.firstUnfinished(), frameResults.nFrames):
+        if frameResults.evaluated[frameId]:
+            continue
+        frame = decodeFrame(frameId, frameResults.ranges)
+        global currentFrameId
+        currentFrameId = frameId
         identifier = createIdentifier(frame)
         calculatePortLoop(datesList, frame, identifier)
-        dfTotalPort.loc[dfTotalPort['ind']==frame,'meanReturn'] = portSummaryDF['return'].mean()
-        dfTotalPort.loc[dfTotalPort['ind']==frame,'meanBeta'] = portSummaryDF['beta'].mean()
-        for x in range(7):
-            dfTotalPort.loc[dfTotalPort['ind']==frame, dfTests[x]] = frame[x]
+        frameResults.record(frameId, portSummaryDF['return'].mean(), portSummaryDF['beta'].mean())
         
         if iports:
             outputIndPort(portSummaryDF, frame)
         
-    dfTotalPort['totalTreynor']=(dfTotalPort['meanReturn']-dfTotalPort['tBill3Mth'])/dfTotalPort['meanBeta']
-    dfTotalPort.sort_values('totalTreynor',ascending=False, inplace=True)
-    dfTotalPort.set_index("T"+dfTotalPort['peTest'].map(str) + dfTotalPort['pbTest'].map(str) +                      dfTotalPort['epsTest'].map(str) + dfTotalPort['deTest'].map(str) +                      dfTotalPort['fcfTest'].map(str) + dfTotalPort['roeTest'].map(str) +                      dfTotalPort['roaTest'].map(str), inplace = True)
+        if time.time() - lastCheckpoint >= checkpointSeconds:
+            frameResults.saveCheckpoint(checkpointName(), checkpointKey())
+            lastCheckpoint = time.time()
+        
+    finishTotalPort()
+    
+    if os.path.exists(checkpointName()):
+        os.remove(checkpointName())
+
+#Same output as prod(), but every frame is scored at once by the numpy engine in backtest_engine.py.
+#Frames whose thresholds pass the same companies are only scored once (see compileGrid).
+#With shardProcesses above 1 the frames are split across that many processes.
+#The per-period and per-portfolio sheets can only be written in a columnar outputFormat; when they are
+#on, every frame is scored in this process so that each one gets its own rows.
+#With extendedStats, dfTotalPort also gets the FrameStats columns (Sharpe, Sortino, hit rate, max
+#drawdown, excess return over the sector average), measured while scoring, shards included.
+def prodFast():
+    global frameStats
+
+    if iports or iperiods:
+        arrays = sectorArrays(panel, sector)
+        if extendedStats:
+            frameStats = FrameStats(frameResults.nFrames, riskFree[:, 0], sectorAverage(arrays))
+        def periodSink(start, picks, hsfScore, periodReturn, periodBeta):
+            if iperiods:
+                resultsWriter.append("IndPortPeriod", periodTable(panel, sector, arrays, frameResults.ranges, \
+                                                                        start, picks, hsfScore))
+            if iports:
+                resultsWriter.append("PortfolioAvgsPerPeriod", portfolioTable(arrays, frameResults.ranges, \
+                                                                              start, picks, hsfScore, periodReturn, periodBeta, \
+                                                                              riskFree[:, 0]))
+        meanReturn, meanBeta = evaluateGrid(arrays, frameResults.ranges, periodSink=periodSink, stats=frameStats)
+        frameResults.record(slice(None), meanReturn, meanBeta)
+        finishTotalPort()
+        return
+
+    evaluate = evaluateGrid
+    if shardProcesses != 1:
+        evaluate = lambda arrays, ranges, **options: evaluateSharded(arrays, ranges, shardProcesses, **options)
+
+    if incrementalUpdate:
+        if portfolioSizes is not None:
+            raise ValueError("portfolioSizes cannot be combined with incrementalUpdate: the saved totals are of the top-5 portfolio")
+        if scoreWeights is not None:
+            raise ValueError("scoreWeights cannot be combined with incrementalUpdate: the saved totals are of the unweighted hsf score")
+        totals = updateTotals()
+        if frameResults is None:
+            board = Leaderboard(leaderboardSize, TBill3Mth, leaderboardObjective, leaderboardEdges)
+            board.push(np.arange(totals.nFrames), totals.meanReturn, totals.meanBeta)
+            finishTotalPort(board)
+        else:
+            frameResults.record(slice(None), totals.meanReturn, totals.meanBeta)
+            finishTotalPort()
+        return
+
+    if frameResults is None:
+        board = Leaderboard(leaderboardSize, TBill3Mth, leaderboardObjective, leaderboardEdges)
+        grid = evaluateLeaderboard(sectorArrays(panel, sector), gridRanges, board, \
+                                   None if shardProcesses == 1 else evaluate)
+        print(sector, 'frames:', grid.nFrames, 'distinct:', grid.nDistinct, 'dedup ratio: %.1f' % grid.ratio, board.summary())
+        finishTotalPort(board, grid)
+        return
+
+    if scoreWeights is not None:
+        weights = np.atleast_2d(np.asarray(scoreWeights, dtype=np.float32))
+        sizes = portfolioSizes or [5]
+        meanReturn, meanBeta, grid = evaluateWeighted(sectorArrays(panel, sector), frameResults.ranges, weights, sizes)
+        print(sector, 'frames:', grid.nFrames, 'distinct:', grid.nDistinct, 'weight sets:', len(weights), 'sizes:', sizes)
+        variants = [(k, size) for k in range(len(weights)) for size in sizes]
+        suffixes = ["_W%d" % k + ("_N%d" % size if portfolioSizes else "") for k, size in variants]
+        columns = [dict(zip(weightColumns, weights[k]), **({'portfolioSize': size} if portfolioSizes else {})) \
+                   for k, size in variants]
+        finishSweep(meanReturn.reshape(len(meanReturn), -1), meanBeta.reshape(len(meanBeta), -1), suffixes, columns)
+        return
+
+    if portfolioSizes is not None:
+        meanReturn, meanBeta, grid = evaluateSizeSweep(sectorArrays(panel, sector), frameResults.ranges, portfolioSizes)
+        print(sector, 'frames:', grid.nFrames, 'distinct:', grid.nDistinct, 'sizes:', portfolioSizes)
+        finishSweep(meanReturn, meanBeta, ["_N%d" % size for size in portfolioSizes], \
+                    [{'portfolioSize': size} for size in portfolioSizes])
+        return
+
+    if extendedStats:
+        meanReturn, meanBeta, frameStats, grid = evaluateWithStats(sectorArrays(panel, sector), frameResults.ranges, \
+                                                                   riskFree[:, 0], evaluate)
+    else:
+        meanReturn, meanBeta, grid = evaluateDeduplicated(sectorArrays(panel, sector), frameResults.ranges, evaluate)
+    frameResults.record(slice(None), meanReturn, meanBeta)
+    print(sector, 'frames:', grid.nFrames, 'distinct:', grid.nDistinct, 'dedup ratio: %.1f' % grid.ratio)
+
+    finishTotalPort()
+
+#Builds dfTotalPort from the frame results, sorted by Treynor ratio, and writes it out.
+#With a leaderboard only its frames are built: board (with the grid of evaluateLeaderboard) when
+#prodFast streamed the grid into one, else a board filled from the frame results.
+def finishTotalPort(board=None, grid=None):
+    global dfTotalPort
+    if board is not None:
+        dfTotalPort = board.toDataFrame(gridRanges, grid, treynorScenarios)
+    elif leaderboardSize is not None:
+        board = Leaderboard(leaderboardSize, TBill3Mth, leaderboardObjective, leaderboardEdges)
+        board.push(np.arange(frameResults.nFrames), frameResults.meanReturn, frameResults.meanBeta)
+        dfTotalPort = board.toDataFrame(gridRanges, scenarios=treynorScenarios)
+    else:
+        dfTotalPort = frameResults.toDataFrame(TBill3Mth, treynorScenarios, frameStats)
+        dfTotalPort.sort_values('totalTreynor',ascending=False, inplace=True)
     
-    outputTotalPort(dfTotalPort, frame)
+    outputTotalPort(dfTotalPort, None)
+
+#dfTotalPort of a sweep: column k of meanReturn and meanBeta holds every frame's results under variant k
+#(a portfolio size or weight set), whose rows are labelled <frame><suffixes[k]> and given the values
+#in columns[k].  All variants are sorted together by Treynor ratio.
+def finishSweep(meanReturn, meanBeta, suffixes, columns):
+    global dfTotalPort
+    tables = []
+    for k in range(len(suffixes)):
+        frameResults.record(slice(None), meanReturn[:, k], meanBeta[:, k])
+        df = frameResults.toDataFrame(TBill3Mth, treynorScenarios)
+        df.index = df.index + suffixes[k]
+        for name, value in columns[k].items():
+            df[name] = value
+        tables.append(df)
+    dfTotalPort = pd.concat(tables)
+    dfTotalPort.sort_values('totalTreynor',ascending=False, inplace=True)
 
-def runSingleSector(sectorChosen, tbill, libor, IndPortfolios, IndPeriods):
+    outputTotalPort(dfTotalPort, None)
+
+#tbill is the 3-month T-bill rate in percent: a number, a pandas Series of rates by date, or a dict of
+#named scenarios of either.  Per-period Treynor ratios use each date's rate and totalTreynor uses the
+#mean rate over the sector's dates; with several scenarios, dfTotalPort is ranked by the first and has
+#a totalTreynor_<name> column for each, all from the same scoring pass.
+def runSingleSector(sectorChosen, tbill, libor, IndPortfolios, IndPeriods, fast=True, processes=1):
 
     global sector
     sector = sectorChosen
     
     getRanges()
-
-    global sectorDF
-    sectorDF = totalDF.loc[totalDF['GICS_SECTOR_NAME']==sector]
     
-    global TBill3Mth
-    TBill3Mth = tbill/100
+    global riskFree, treynorScenarios, TBill3Mth
+    names, riskFree = riskFreeTable(datesList, tbill)
+    scenarioRates = dict(zip(names, meanRiskFree(riskFree, panel.counts(sector) > 0)))
+    treynorScenarios = scenarioRates if len(names) > 1 else None
+    TBill3Mth = scenarioRates[names[0]]
     global Libor3Mth
     Libor3Mth = libor/100
     
@@ -144,33 +454,60 @@ def runSingleSector(sectorChosen, tbill, libor, IndPortfolios, IndPeriods):
     iports = IndPortfolios
     global iperiods
     iperiods = IndPeriods
+    global shardProcesses
+    shardProcesses = processes
     
     global portSummaryDF
     portSummaryDF = pd.DataFrame([],index=datesList)
     portSummaryDF['return']=None
     portSummaryDF['beta']=None
-    portSummaryDF['tBill3Mth']=TBill3Mth
+    portSummaryDF['tBill3Mth']=riskFree[:, 0]
     portSummaryDF['treynor']=None
     for x in range(7):
             portSummaryDF[dfTests[x]] = None
     portSummaryDF['maxHSFScore']=None
 
-    global dfTotalPort
-    dfTotalPort = pd.DataFrame([])
-    dfTotalPort['ind']=list(product(peRange,pbRange,epsRange,deRange,fcfRange,roeRange,roaRange))
-    dfTotalPort['meanReturn']=None
-    dfTotalPort['meanBeta']=None
-    dfTotalPort['tBill3Mth']=TBill3Mth
-    dfTotalPort['totalTreynor']=None
-    for x in range(7):
-            dfTotalPort[dfTests[x]] = None
+    global gridRanges
+    gridRanges = [peRange, pbRange, epsRange, deRange, fcfRange, roeRange, roaRange]
+
+    #prodFast streams a leaderboard run without per-frame results; everything else records them all
+    global frameStats
+    frameStats = None
 
-    prod()
+    global frameResults
+    if leaderboardSize is not None and fast and not (iports or iperiods):
+        frameResults = None
+    else:
+        frameResults = FrameResults(gridRanges)
+
+    global resultsWriter
+    resultsWriter = BackgroundWriter(outputDirectory(), outputFormat)
+
+    if fast and (outputFormat != 'csv' or not (iports or iperiods)):
+        prodFast()
+    else:
+        prod()
+
+    resultsWriter.close()
+    if iports or iperiods:
+        print(sector, 'output bytes written:', resultsWriter.status()['bytesWritten'])
+
+#Estimated cost of running a sector: number of frames times the number of company rows it scores
+def estimateCost(sectorChosen):
+    global sector
+    sector = sectorChosen
+    getRanges()
+    nFrames = len(peRange)*len(pbRange)*len(epsRange)*len(deRange)*len(fcfRange)*len(roeRange)*len(roaRange)
+    print(sector, 'grid:', [len(r) for r in (peRange, pbRange, epsRange, deRange, fcfRange, roeRange, roaRange)], \
+          'frames:', nFrames)
+    return nFrames * int(panel.counts(sectorChosen).sum())
 
 start = time.time()
 
-for s in sectors:
-    runSingleSector(s, 0.09, 0.23, False, False)
+#processes=None uses every core; set it to 1 to run the sectors one after another
+processes = None
+costs = {s: estimateCost(s) for s in sectors}
+runSectorsParallel(runSingleSector, costs, (0.09, 0.23, False, False), processes)
 
 stop = time.time()
 
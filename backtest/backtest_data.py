@@ -0,0 +1,390 @@
+#Input loading and layout for the HSF backtest.
+#Source exports are parsed once into a binary cache, and the panel is sorted once by sector and then
+#by date and kept as contiguous arrays plus an offset table (like a CSR matrix), so the rows of any
+#(sector, date) are a plain slice found in O(1).
+import os
+import json
+import hashlib
+import pandas as pd
+import numpy as np
+
+from backtest_engine import metrics, denseSectorArrays
+from backtest_ranges import sectorsRangePlan, loadRangePlan
+
+sectorColumn = 'GICS_SECTOR_NAME'
+tickerColumn = 'TICKER'
+
+#Columns of the export the backtest reads; every other column is skipped when loading
+valueColumns = ['DATE', sectorColumn, tickerColumn] + metrics + ['ADJUSTED_BETA', 'RETURN']
+
+#Metrics are held as float32 (half the memory of float64).  Returns and betas stay float64 since
+#they are averaged into the results.  Set metricDtype = np.float64 to compare at full precision.
+metricDtype = np.float32
+
+#Bumped whenever the cache layout changes, so old caches are rebuilt
+cacheVersion = 2
+
+#Reads the columns in valueColumns with compact dtypes: float32 metrics and categorical sector and
+#ticker.  A ticker column is optional.
+def readValuesCSV(path):
+    dtypes = {m: metricDtype for m in metrics}
+    dtypes.update({sectorColumn: 'category', tickerColumn: 'category', 'RETURN': np.float64, 'ADJUSTED_BETA': np.float64})
+    return pd.read_csv(path, index_col='DATE', parse_dates=True, usecols=lambda c: c in valueColumns, dtype=dtypes)
+
+#Dtype of the metrics and the columns read, kept with every cache so changing either rebuilds it
+def cacheLayout():
+    return {'metricDtype': np.dtype(metricDtype).str, 'valueColumns': list(valueColumns)}
+
+def readRangesExcel(path):
+    return pd.read_excel(path, index_col=[0, 1])
+
+def fileHash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+#Stores a dataframe as one .npy file per column plus meta.json (index names and the source key).
+#Categorical columns are stored as their integer codes plus a file of categories.
+def writeCache(df, cacheDir, meta):
+    os.makedirs(cacheDir, exist_ok=True)
+    flat = df.reset_index()
+    meta = dict(meta, version=cacheVersion, index=[str(n) for n in df.index.names], columns=[], categorical=[])
+    for i, col in enumerate(flat.columns):
+        values = flat[col].to_numpy()
+        if isinstance(flat[col].dtype, pd.CategoricalDtype):
+            categories = flat[col].cat.categories.to_numpy(dtype=str)
+            np.save(os.path.join(cacheDir, "%d.categories.npy" % i), categories, allow_pickle=False)
+            values = flat[col].cat.codes.to_numpy()
+            meta['categorical'].append(str(col))
+        elif values.dtype == object:
+            values = flat[col].to_numpy(dtype=str)
+            if values.dtype == object:
+                values = values.astype(str)
+        np.save(os.path.join(cacheDir, "%d.npy" % i), values, allow_pickle=False)
+        meta['columns'].append(str(col))
+    with open(os.path.join(cacheDir, "meta.json"), 'w') as f:
+        json.dump(meta, f)
+
+def readCache(cacheDir, meta):
+    columns = {}
+    for i, col in enumerate(meta['columns']):
+        values = np.load(os.path.join(cacheDir, "%d.npy" % i), allow_pickle=False)
+        if col in meta['categorical']:
+            categories = np.load(os.path.join(cacheDir, "%d.categories.npy" % i), allow_pickle=False)
+            values = pd.Categorical.from_codes(values, categories)
+        columns[col] = values
+    return pd.DataFrame(columns).set_index(meta['index'])
+
+#Loads a source file through a binary cache kept in <path>.cache.  The cache is used while the file's
+#size and mtime are unchanged; if only the mtime changed, the file is hashed and the cache is kept when
+#the contents are the same.  Otherwise, or when cacheLayout() has changed, reader(path) parses the file
+#again and the cache is rebuilt.
+def loadCached(path, reader=readValuesCSV):
+    cacheDir = path + ".cache"
+    metaPath = os.path.join(cacheDir, "meta.json")
+    info = os.stat(path)
+    meta = None
+    if os.path.exists(metaPath):
+        with open(metaPath) as f:
+            meta = json.load(f)
+        if meta.get('version') != cacheVersion or meta.get('reader') != reader.__name__ \
+                or meta.get('layout') != cacheLayout() or meta.get('size') != info.st_size:
+            meta = None
+
+    if meta is not None and meta.get('mtime') == info.st_mtime_ns:
+        return readCache(cacheDir, meta)
+
+    digest = fileHash(path)
+    if meta is not None and meta.get('sha1') == digest:
+        meta['mtime'] = info.st_mtime_ns
+        with open(metaPath, 'w') as f:
+            json.dump(meta, f)
+        return readCache(cacheDir, meta)
+
+    df = reader(path)
+    writeCache(df, cacheDir, {'size': info.st_size, 'mtime': info.st_mtime_ns, 'sha1': digest, \
+                              'reader': reader.__name__, 'layout': cacheLayout()})
+    return df
+
+#offsets[s, d] is the first row of sector s on date d and offsets[s, -1] is the end of sector s.
+#values/returns/betas hold the rows as numpy arrays (memory-mapped for a panel opened from streamed
+#shards), with tickers given as codes into tickerNames.  No dataframe of the rows is kept; those of a
+#block or of picked rows are built from the arrays on request.
+class Panel:
+    def __init__(self, sectors, dates, offsets, values, returns, betas, tickers=None, tickerNames=None):
+        self.sectors = sectors
+        self.dates = dates
+        self.offsets = offsets
+        self.values = values
+        self.returns = returns
+        self.betas = betas
+        self.tickers = tickers
+        self.tickerNames = tickerNames
+        self.sectorCodes = {name: i for i, name in enumerate(sectors)}
+        self.dateCodes = {date: i for i, date in enumerate(dates)}
+
+    #Row slice of one sector, or of one (sector, date) block when date is given
+    def rows(self, sector, date=None):
+        s = self.sectorCodes[sector]
+        if date is None:
+            return slice(self.offsets[s, 0], self.offsets[s, -1])
+        d = self.dateCodes[date]
+        return slice(self.offsets[s, d], self.offsets[s, d+1])
+
+    #Number of rows on each date for one sector
+    def counts(self, sector):
+        return np.diff(self.offsets[self.sectorCodes[sector]])
+
+    def blockFrame(self, sector, date):
+        rows = self.rows(sector, date)
+        return self.rowsFrame(sector, rows, np.repeat(pd.DatetimeIndex([date]), rows.stop - rows.start))
+
+    #Dataframe of some rows of one sector in the layout of totalDF (indexed by DATE)
+    def rowsFrame(self, sector, rows, rowDates):
+        df = pd.DataFrame(np.asarray(self.values[rows]), columns=metrics, index=pd.DatetimeIndex(rowDates, name='DATE'))
+        df.insert(0, sectorColumn, sector)
+        if self.tickers is not None:
+            df.insert(1, tickerColumn, np.asarray(self.tickerNames, dtype=object)[self.tickers[rows]])
+        df['ADJUSTED_BETA'] = self.betas[rows]
+        df['RETURN'] = self.returns[rows]
+        return df
+
+    #Rows at positions rows, on dates rowDates, in the layout of blockFrame
+    def takeRows(self, sector, rows, rowDates):
+        return self.rowsFrame(sector, rows, rowDates)
+
+    #Hash of everything the backtest reads for one sector (dates, row counts, metrics, returns, betas).
+    #It changes whenever the sector's data does, so it can key checkpoints and saved results.
+    def fingerprint(self, sector):
+        rows = self.rows(sector)
+        digest = hashlib.sha1()
+        digest.update(np.asarray(self.dates.asi8).tobytes())
+        digest.update(self.counts(sector).tobytes())
+        for data in (self.values, self.returns, self.betas):
+            digest.update(np.ascontiguousarray(data[rows]).tobytes())
+        return digest.hexdigest()
+
+    #Hash of each (sector, date) partition: the date and its rows' metrics, returns and betas
+    def partitionHashes(self, sector):
+        hashes = []
+        for d, date in enumerate(self.dates):
+            rows = self.rows(sector, date)
+            digest = hashlib.sha1(np.int64(self.dates.asi8[d]).tobytes())
+            for data in (self.values, self.returns, self.betas):
+                digest.update(np.ascontiguousarray(data[rows]).tobytes())
+            hashes.append(digest.hexdigest())
+        return np.array(hashes)
+
+    #SectorArrays for the engine, built from the sector's contiguous rows (rowIds are panel rows).
+    #datePositions keeps only those dates (positions in dates), e.g. the dates whose data changed.
+    def sectorArrays(self, sector, datePositions=None):
+        if datePositions is None:
+            rows = self.rows(sector)
+            return denseSectorArrays(self.values[rows], self.returns[rows], self.betas[rows], \
+                                     self.counts(sector), self.dates, np.arange(rows.start, rows.stop))
+        datePositions = np.asarray(datePositions, dtype=np.int64)
+        starts = self.offsets[self.sectorCodes[sector], datePositions]
+        counts = self.offsets[self.sectorCodes[sector], datePositions + 1] - starts
+        rows = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return denseSectorArrays(self.values[rows], self.returns[rows], self.betas[rows], \
+                                 counts, self.dates[datePositions], rows)
+
+#Manifest of one sector of a panel: its dates, the hash of each (sector, date) partition and the
+#rows themselves, saved with a run's results so the next run can tell which partitions changed and
+#take their old contributions back out
+def sectorManifest(panel, sector):
+    rows = panel.rows(sector)
+    return {'dates': np.asarray(panel.dates.asi8), 'hashes': panel.partitionHashes(sector),
+            'counts': panel.counts(sector), 'values': np.asarray(panel.values[rows]),
+            'returns': np.asarray(panel.returns[rows]), 'betas': np.asarray(panel.betas[rows])}
+
+#One-sector Panel of the rows in a manifest
+def manifestPanel(manifest, sector):
+    offsets = np.concatenate(([0], np.cumsum(manifest['counts'])))[np.newaxis, :]
+    return Panel([sector], pd.DatetimeIndex(manifest['dates']), offsets, \
+                 manifest['values'], manifest['returns'], manifest['betas'])
+
+#Dates of a sector whose partitions differ between a manifest and a panel, as (positions in the
+#manifest's dates that were restated or dropped, positions in the panel's dates that are new or restated)
+def changedPartitions(manifest, panel, sector):
+    previous = dict(zip(manifest['dates'].tolist(), manifest['hashes'].tolist()))
+    current = dict(zip(panel.dates.asi8.tolist(), panel.partitionHashes(sector).tolist()))
+    stale = [d for d, date in enumerate(manifest['dates'].tolist()) if current.get(date) != previous[date]]
+    fresh = [d for d, date in enumerate(panel.dates.asi8.tolist()) if previous.get(date) != current[date]]
+    return stale, fresh
+
+#Panel offsets from the number of rows of each (sector, date), with sectors laid out one after another
+def offsetTable(counts):
+    offsets = np.zeros((counts.shape[0], counts.shape[1] + 1), dtype=np.int64)
+    offsets[:, 1:] = np.cumsum(counts, axis=1)
+    offsets += np.concatenate(([0], np.cumsum(counts.sum(axis=1))[:-1]))[:, np.newaxis].astype(np.int64)
+    return offsets
+
+#Sorts the rows of totalDF (indexed by date) by sector and date into the panel's arrays, keeping file
+#order within each block, and builds the offset table.  Rows on dates outside datesList are dropped.
+#totalDF itself is not kept, so the caller can let it go once the panel is built.
+def buildPanel(totalDF, datesList):
+    dates = pd.DatetimeIndex(datesList)
+    sectorCodes, sectors = pd.factorize(totalDF[sectorColumn])
+    dateCodes = dates.get_indexer(totalDF.index)
+    keep = np.flatnonzero((dateCodes >= 0) & (sectorCodes >= 0))
+
+    #lexsort is stable, so rows of the same (sector, date) stay in their original order
+    order = keep[np.lexsort((dateCodes[keep], sectorCodes[keep]))]
+
+    counts = np.bincount(sectorCodes[order] * len(dates) + dateCodes[order], \
+                         minlength=len(sectors) * len(dates)).reshape(len(sectors), len(dates))
+    offsets = offsetTable(counts)
+
+    values = np.ascontiguousarray(totalDF[metrics].to_numpy(dtype=metricDtype)[order])
+    returns = np.ascontiguousarray(totalDF['RETURN'].to_numpy(dtype=float)[order])
+    betas = np.ascontiguousarray(totalDF['ADJUSTED_BETA'].to_numpy(dtype=float)[order])
+    tickers, tickerNames = None, None
+    if tickerColumn in totalDF:
+        tickerCodes, tickerNames = pd.factorize(totalDF[tickerColumn])
+        tickers, tickerNames = tickerCodes[order].astype(np.int32), list(tickerNames)
+
+    return Panel(list(sectors), dates, offsets, values, returns, betas, tickers, tickerNames)
+
+#One row of a streaming ingest spool file
+def spoolRecord():
+    return np.dtype([('ticker', np.int32), ('metrics', metricDtype, (len(metrics),)), \
+                     ('RETURN', np.float64), ('ADJUSTED_BETA', np.float64)])
+
+#Gives every new value of a column the next free code and returns the codes of all its values
+def assignCodes(column, codes):
+    for value in column.unique():
+        if value not in codes:
+            codes[value] = len(codes)
+    return column.map(codes).to_numpy()
+
+#Yields (sector, metric values) of the range spools of ingestStreaming in order of sector name,
+#removing each spool once it is read
+def spooledSectors(rangesDir, codes):
+    for sector in sorted(codes):
+        path = os.path.join(rangesDir, "%d.bin" % codes[sector])
+        values = np.fromfile(path, dtype=metricDtype).reshape(-1, len(metrics))
+        os.remove(path)
+        yield sector, values
+
+#Streaming ingest for exports too large to load at once.  The CSV is read chunkRows rows at a time;
+#each chunk is projected to valueColumns, cleaned with dropna, cut at startDate and appended to one
+#spool file per (sector, date).  The spools are then laid out by sector and date, exactly like a
+#Panel, as .npy files in shardDir that openShards memory-maps.  Peak memory is set by chunkRows (and
+#the largest single (sector, date) block), not by the size of the file.
+#The metrics of every row, before cleaning and cutting, are also spooled per sector and turned into
+#the range plan of the whole export (shardRangePlan), the same plan the loaded export gives.  The plan
+#holds every non-missing metric value of the export (about rows x 7 numbers), so building it takes
+#that much memory, plus the rows of the largest sector; it is built one sector at a time.
+#Nothing is done when shardDir already holds shards of the same file and startDate.
+def ingestStreaming(path, shardDir, startDate, chunkRows=1000000):
+    info = os.stat(path)
+    source = {'size': info.st_size, 'mtime': info.st_mtime_ns, 'startDate': str(startDate), 'version': cacheVersion, \
+              'layout': cacheLayout()}
+    metaPath = os.path.join(shardDir, "meta.json")
+    if os.path.exists(metaPath):
+        with open(metaPath) as f:
+            if json.load(f).get('source') == source:
+                return shardDir
+        os.remove(metaPath)
+
+    spoolDir = os.path.join(shardDir, "spool")
+    rangesDir = os.path.join(shardDir, "rangespool")
+    for directory in (spoolDir, rangesDir):
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+    record = spoolRecord()
+    sectorCodes, dateCodes, tickerCodes, rangeCodes = {}, {}, {}, {}
+    dtypes = {m: metricDtype for m in metrics}
+    dtypes.update({sectorColumn: str, tickerColumn: str, 'RETURN': np.float64, 'ADJUSTED_BETA': np.float64})
+    reader = pd.read_csv(path, usecols=lambda c: c in valueColumns, dtype=dtypes, parse_dates=['DATE'], \
+                         chunksize=chunkRows)
+    for chunk in reader:
+        raw = chunk.dropna(subset=[sectorColumn])
+        codes = assignCodes(raw[sectorColumn], rangeCodes)
+        for code in np.unique(codes):
+            with open(os.path.join(rangesDir, "%d.bin" % code), 'ab') as f:
+                raw[metrics].to_numpy(dtype=metricDtype)[codes == code].tofile(f)
+
+        chunk = chunk.dropna(axis='index', how='any')
+        chunk = chunk.loc[chunk['DATE'] >= startDate]
+        if chunk.empty:
+            continue
+
+        rows = np.zeros(len(chunk), dtype=record)
+        rows['ticker'] = assignCodes(chunk[tickerColumn], tickerCodes) if tickerColumn in chunk else -1
+        rows['metrics'] = chunk[metrics].to_numpy(dtype=metricDtype)
+        rows['RETURN'] = chunk['RETURN'].to_numpy()
+        rows['ADJUSTED_BETA'] = chunk['ADJUSTED_BETA'].to_numpy()
+
+        keys = assignCodes(chunk[sectorColumn], sectorCodes) * (1 << 32) + assignCodes(chunk['DATE'], dateCodes)
+        order = np.argsort(keys, kind='stable')
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+        for block in np.split(order, bounds):
+            key = keys[block[0]]
+            with open(os.path.join(spoolDir, "%d_%d.bin" % (key >> 32, key & 0xffffffff)), 'ab') as f:
+                rows[block].tofile(f)
+
+    #Lay the spools out by sector and then by date
+    dates = sorted(dateCodes)
+    dateOrder = [dateCodes[date] for date in dates]
+    datePositions = {d: position for position, d in enumerate(dateOrder)}
+    counts = np.zeros((len(sectorCodes), len(dates)), dtype=np.int64)
+    spools = {}
+    for name in os.listdir(spoolDir):
+        s, d = [int(part) for part in name[:-4].split('_')]
+        spools[s, d] = os.path.join(spoolDir, name)
+        counts[s, datePositions[d]] = os.path.getsize(spools[s, d]) // record.itemsize
+    offsets = offsetTable(counts)
+
+    nRows = int(counts.sum())
+    values = np.lib.format.open_memmap(os.path.join(shardDir, "values.npy"), 'w+', metricDtype, (nRows, len(metrics)))
+    returns = np.lib.format.open_memmap(os.path.join(shardDir, "returns.npy"), 'w+', np.float64, (nRows,))
+    betas = np.lib.format.open_memmap(os.path.join(shardDir, "betas.npy"), 'w+', np.float64, (nRows,))
+    tickers = np.lib.format.open_memmap(os.path.join(shardDir, "tickers.npy"), 'w+', np.int32, (nRows,))
+    for s in range(len(sectorCodes)):
+        for position, d in enumerate(dateOrder):
+            if (s, d) not in spools:
+                continue
+            rows = np.fromfile(spools[s, d], dtype=record)
+            start = offsets[s, position]
+            values[start:start+len(rows)] = rows['metrics']
+            returns[start:start+len(rows)] = rows['RETURN']
+            betas[start:start+len(rows)] = rows['ADJUSTED_BETA']
+            tickers[start:start+len(rows)] = rows['ticker']
+            os.remove(spools[s, d])
+    for data in (values, returns, betas, tickers):
+        data.flush()
+    del values, returns, betas, tickers
+    os.rmdir(spoolDir)
+
+    sectorsRangePlan(spooledSectors(rangesDir, rangeCodes)).save(os.path.join(shardDir, "ranges.npz"), json.dumps(source))
+    os.rmdir(rangesDir)
+
+    meta = {'source': source,
+            'sectors': list(sectorCodes),
+            'dates': [str(date) for date in dates],
+            'tickers': list(tickerCodes),
+            'offsets': offsets.tolist()}
+    with open(metaPath, 'w') as f:
+        json.dump(meta, f)
+    return shardDir
+
+#Range plan of the whole export written by ingestStreaming
+def shardRangePlan(shardDir):
+    with open(os.path.join(shardDir, "meta.json")) as f:
+        meta = json.load(f)
+    return loadRangePlan(os.path.join(shardDir, "ranges.npz"), json.dumps(meta['source']))
+
+#Opens shards written by ingestStreaming as a Panel whose arrays are memory-mapped
+def openShards(shardDir):
+    with open(os.path.join(shardDir, "meta.json")) as f:
+        meta = json.load(f)
+    load = lambda name: np.load(os.path.join(shardDir, name + ".npy"), mmap_mode='r')
+    return Panel(meta['sectors'], pd.DatetimeIndex(pd.to_datetime(meta['dates'])), \
+                 np.array(meta['offsets'], dtype=np.int64).reshape(len(meta['sectors']), -1), \
+                 load("values"), load("returns"), load("betas"), load("tickers"), meta['tickers'])
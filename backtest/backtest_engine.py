@@ -0,0 +1,840 @@
+#Vectorized scoring engine for the HSF backtest.
+#Instead of slicing a dataframe for every date of every frame, each sector is held as a
+#dates x tickers x metrics array and a whole block of frames is scored with a few numpy operations.
+import os
+from itertools import product
+import pandas as pd
+import numpy as np
+
+metrics = [ 'PE_RATIO', 'PX_TO_BOOK_RATIO', 'TRAIL_12M_EPS', 'TOT_DEBT_TO_TOT_EQY', \
+               'PX_TO_FREE_CASH_FLOW', 'RETURN_COM_EQY', 'RETURN_ON_ASSET' ]
+
+dfTests = ['peTest','pbTest','epsTest','deTest','fcfTest','roeTest','roaTest']
+dfScores = ['peScore','pbScore','epsScore','deScore','fcfScore','roeScore','roaScore']
+
+lvhs_metrics = [ 'PE_RATIO', 'TOT_DEBT_TO_TOT_EQY', 'PX_TO_BOOK_RATIO' ] # Low-value high score metrics
+
+#A metric passes when sign*value < sign*threshold, so low-value metrics test value < threshold
+#and every other metric tests value > threshold, exactly like calculatePortLoop
+metricSigns = np.array([1.0 if m in lvhs_metrics else -1.0 for m in metrics])
+
+#Number of companies held in each period's portfolio
+portfolioSize = 5
+
+#Small amount added to the average beta so the Treynor ratio never divides by zero
+betaOffset = 0.0000001
+
+#Upper bound on the number of (frame, date, ticker, metric) cells scored at once
+maxBlockCells = 2**25
+
+#Holds one sector as dense arrays.  Each date gets one row, and the companies on that date fill
+#the ticker slots in the same order they appear in sectorDF.  Unused slots are marked invalid.
+#rowIds, when known, gives the source row of each slot (-1 for unused slots) for output sheets.
+#signs gives each metric's direction as in metricSigns (rankArrays sets every metric to test value < threshold).
+class SectorArrays:
+    def __init__(self, values, returns, betas, valid, dates, rowIds=None, signs=metricSigns):
+        self.values = values
+        self.returns = returns
+        self.betas = betas
+        self.valid = valid
+        self.dates = dates
+        self.rowIds = rowIds
+        self.signs = signs
+
+    @property
+    def nDates(self):
+        return self.values.shape[0]
+
+    @property
+    def nTickers(self):
+        return self.values.shape[1]
+
+#Builds SectorArrays from rows that are already grouped by date in the order of dates,
+#with counts[d] rows on date d (the layout of one sector of a Panel)
+def denseSectorArrays(values, returns, betas, counts, dates, rowIds=None):
+    dateCodes = np.repeat(np.arange(len(counts)), counts)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    slots = np.arange(len(dateCodes)) - starts[dateCodes]
+    nTickers = max(int(counts.max()) if len(counts) else 0, 1)
+
+    denseValues = np.full((len(counts), nTickers, len(metrics)), np.nan, dtype=values.dtype)
+    denseReturns = np.zeros((len(counts), nTickers))
+    denseBetas = np.zeros((len(counts), nTickers))
+    valid = np.zeros((len(counts), nTickers), dtype=bool)
+
+    denseValues[dateCodes, slots] = values
+    denseReturns[dateCodes, slots] = returns
+    denseBetas[dateCodes, slots] = betas
+    valid[dateCodes, slots] = True
+
+    denseRowIds = None
+    if rowIds is not None:
+        denseRowIds = np.full((len(counts), nTickers), -1, dtype=np.int64)
+        denseRowIds[dateCodes, slots] = rowIds
+
+    return SectorArrays(denseValues, denseReturns, denseBetas, valid, dates, denseRowIds)
+
+#Percentile thresholds: a metric passes when the company is in the best p% of its sector on the date,
+#i.e. when fewer than p% of that date's companies are better on it (lower for low-value metrics,
+#higher for the rest; equal values are not better).  rankArrays replaces every value by that share in
+#whole percent, floor(100 * better / companies), stored as uint8 with 100 for missing values and empty
+#slots.  Every metric then passes on rank < p, so a frame of percentiles p (1..100) is scored by the
+#same mask cache as absolute thresholds, on integers with at most 101 distinct values per metric.
+rankSigns = np.ones(len(metrics))
+
+def rankArrays(arrays):
+    present = arrays.valid[:, :, np.newaxis] & ~np.isnan(arrays.values)
+    signed = np.where(present, arrays.values * arrays.signs, np.inf)
+    order = np.argsort(signed, axis=1, kind='stable')
+    ordered = np.take_along_axis(signed, order, axis=1)
+
+    #Companies better than each sorted one: the position of the first of its run of equal values
+    slots = np.arange(arrays.nTickers)[np.newaxis, :, np.newaxis]
+    newRun = np.ones(ordered.shape, dtype=bool)
+    newRun[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    better = np.empty(ordered.shape, dtype=np.int64)
+    np.put_along_axis(better, order, np.maximum.accumulate(np.where(newRun, slots, 0), axis=1), axis=1)
+
+    companies = np.maximum(present.sum(axis=1, keepdims=True), 1)
+    ranks = np.where(present, 100 * better // companies, 100).astype(np.uint8)
+    return SectorArrays(ranks, arrays.returns, arrays.betas, arrays.valid, arrays.dates, arrays.rowIds, rankSigns)
+
+#Averages return and beta of the chosen tickers on every date.  Dates with no companies give NaN.
+def periodAverages(arrays, picks):
+    count = picks.sum(axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        periodReturn = (picks * arrays.returns).sum(axis=2) / count
+        periodBeta = (picks * arrays.betas).sum(axis=2) / count + betaOffset
+    return periodReturn, periodBeta
+
+#Mean over dates that skips NaN like pandas does, without the empty-slice warning
+def nanMean(values, axis):
+    have = ~np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(have, values, 0).sum(axis=axis) / have.sum(axis=axis)
+
+#Pass masks for every threshold a metric can take, packed 64 tickers to a word.
+#masks[x] has shape (thresholds of metric x, dates, words) and is built once per sector.
+class MaskCache:
+    def __init__(self, thresholds, masks, validBits, nTickers):
+        self.thresholds = thresholds
+        self.masks = masks
+        self.validBits = validBits
+        self.nTickers = nTickers
+
+#Packs a boolean array along its last axis into uint64 words (bit i of word w is ticker 64*w+i)
+def packBits(passes):
+    nWords = -(-passes.shape[-1] // 64)
+    padding = [(0, 0)] * (passes.ndim - 1) + [(0, nWords * 64 - passes.shape[-1])]
+    packed = np.packbits(np.pad(passes, padding), axis=-1, bitorder='little')
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+#Inverse of packBits, returning a uint8 array with nTickers entries along the last axis
+def unpackBits(words, nTickers):
+    return np.unpackbits(words.view(np.uint8), axis=-1, bitorder='little')[..., :nTickers]
+
+#Number of set bits in every uint64 word (np.bitwise_count needs numpy 2.0, older versions use a byte table)
+if hasattr(np, 'bitwise_count'):
+    def popcount(words):
+        return np.bitwise_count(words)
+else:
+    byteCounts = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    def popcount(words):
+        counts = byteCounts[words.view(np.uint8)]
+        return counts.reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+#Compares every ticker against every distinct threshold of every metric once, for one sector.
+#ranges are the seven threshold ranges in the order of metrics (peRange ... roaRange).
+def buildMaskCache(arrays, ranges):
+    thresholds = []
+    masks = []
+    for x in range(len(metrics)):
+        values = np.asarray(list(ranges[x]), dtype=float)
+        signed = arrays.values[:, :, x] * arrays.signs[x]
+        passes = signed[np.newaxis] < (values * arrays.signs[x])[:, np.newaxis, np.newaxis]
+        thresholds.append(values)
+        masks.append(packBits(passes))
+    return MaskCache(thresholds, masks, packBits(arrays.valid), arrays.nTickers)
+
+#Adds one pass mask to a bit-sliced counter held as three bit planes (bit0, bit1, bit2).
+#Seven masks never overflow the three planes, so each ticker's hsf score is read straight off its bits.
+def addMask(planes, add):
+    bit0, bit1, bit2 = planes
+    carry = bit0 & add
+    return bit0 ^ add, bit1 ^ carry, bit2 ^ (bit1 & carry)
+
+#Adds every threshold mask of one metric to every counter in planes, so (P, dates, words) planes
+#become (P * thresholds, dates, words) with the new metric varying fastest, like product()
+def expandPlanes(planes, masks):
+    grown = addMask([p[:, np.newaxis] for p in planes], masks[np.newaxis])
+    return tuple(p.reshape((-1,) + p.shape[2:]) for p in grown)
+
+#Counter planes for frames given as threshold indices (frames x 7), built from cached masks only
+def cachedPlanes(cache, indices):
+    bit0 = cache.masks[0][indices[:, 0]]
+    planes = (bit0, np.zeros_like(bit0), np.zeros_like(bit0))
+    for x in range(1, len(metrics)):
+        planes = addMask(planes, cache.masks[x][indices[:, x]])
+    return planes
+
+#Unpacks counter planes into the hsf score of every (frame, date, ticker), -1 for empty slots
+def planeScores(arrays, cache, planes):
+    hsfScore = unpackBits(planes[0], cache.nTickers).astype(np.int8)
+    hsfScore += unpackBits(planes[1], cache.nTickers).astype(np.int8) << 1
+    hsfScore += unpackBits(planes[2], cache.nTickers).astype(np.int8) << 2
+    hsfScore[:, ~arrays.valid] = -1
+    return hsfScore
+
+#Keeps, in every word, only the lowest keep[...] set bits of words (keep is never above size)
+def lowestBits(words, keep, size):
+    kept = np.zeros_like(words)
+    rest = words.copy()
+    for i in range(size):
+        low = rest & (~rest + np.uint64(1))
+        kept |= np.where(keep > i, low, np.uint64(0))
+        rest ^= low
+    return kept
+
+#Top-N selection straight from the counter planes, returning the chosen tickers as packed bits.
+#For each score from 7 down, the tickers at that score are one bitwise expression of the planes and
+#popcount says how many there are, so a whole level is taken at once until fewer places remain than
+#tickers at the level; then the lowest slots at that level fill the remaining places.
+#Tie order: among tickers with the same score, the one that comes first in sectorDF on that date wins.
+#This is what calculatePortLoop's stable (mergesort) sort_values followed by iloc[0:5] picks.
+#If a date has fewer than size companies, all of them are taken.
+def selectTopBits(planes, validBits, size=portfolioSize):
+    bit0, bit1, bit2 = planes
+    chosen = np.zeros_like(bit0)
+    remaining = np.full(bit0.shape[:2] + (1,), size, dtype=np.int32)
+    for level in range(len(metrics), -1, -1):
+        atLevel = np.broadcast_to(validBits, bit0.shape)
+        for bit, plane in enumerate(planes):
+            atLevel = atLevel & (plane if level >> bit & 1 else ~plane)
+        counts = popcount(atLevel).astype(np.int32)
+        before = np.cumsum(counts, axis=2) - counts
+        keep = np.clip(remaining - before, 0, counts)
+        chosen |= np.where(keep >= counts, atLevel, lowestBits(atLevel, keep, size))
+        remaining -= np.minimum(counts.sum(axis=2, keepdims=True), remaining)
+        if not remaining.any():
+            break
+    return chosen
+
+#Yields (start, stop, planes) for consecutive blocks of frames first..last-1 of the grid,
+#scoring every frame from scratch
+def flatBlocks(cache, blockSize, first, last):
+    shape = tuple(len(t) for t in cache.thresholds)
+    for start in range(first, last, blockSize):
+        stop = min(start + blockSize, last)
+        indices = np.stack(np.unravel_index(np.arange(start, stop), shape), axis=1)
+        yield start, stop, cachedPlanes(cache, indices)
+
+#Yields the same blocks as flatBlocks by walking the grid as a tree.  The partial count of the first
+#k metrics is built once per prefix and shared by all of its children, so a leaf frame only pays for
+#adding its innermost mask.  Outer metrics are walked depth first; the metrics below the split level
+#are expanded breadth first in one block, which keeps each block within blockSize frames.
+#Subtrees entirely outside first..last-1 are skipped.
+def treeBlocks(cache, blockSize, first, last):
+    sizes = [len(t) for t in cache.thresholds]
+    split = len(sizes)
+    while split > 0 and np.prod(sizes[split-1:]) <= blockSize:
+        split -= 1
+    strides = [int(np.prod(sizes[level+1:])) for level in range(len(sizes))]
+
+    zeros = np.zeros((1,) + cache.masks[0].shape[1:], dtype=np.uint64)
+
+    def walk(level, planes, base):
+        if level == split:
+            for x in range(split, len(sizes)):
+                planes = expandPlanes(planes, cache.masks[x])
+            yield base, planes
+            return
+        for i in range(sizes[level]):
+            start = base + i * strides[level]
+            if start + strides[level] <= first or start >= last:
+                continue
+            for leaves in walk(level + 1, addMask(planes, cache.masks[level][i:i+1]), start):
+                yield leaves
+
+    for base, planes in walk(0, (zeros, zeros, zeros), 0):
+        start = max(base, first)
+        stop = min(base + len(planes[0]), last)
+        yield start, stop, tuple(p[start-base:stop-base] for p in planes)
+
+#Evaluates every frame of the full cartesian product of ranges, in the order product() yields it, and
+#returns the mean return and mean beta of each one, as prod() does.  Scoring uses a MaskCache instead
+#of comparing floats for every frame.
+#tree=True reuses partial sums across frames that share leading thresholds (see treeBlocks).
+#frameRange=(first, last) evaluates only those frame IDs and returns arrays of last-first results.
+#periodSink, if given, is called for every block as periodSink(start, picks, hsfScore, periodReturn,
+#periodBeta) with the per-(frame, date) detail that the per-period and per-portfolio sheets need.
+#totals, if given, is a FrameTotals of the grid that every block's period averages are added to, and
+#stats a FrameStats of the frames in frameRange that every block's period returns are measured into.
+def evaluateGrid(arrays, ranges, blockSize=None, cache=None, tree=True, frameRange=None, periodSink=None, \
+                 totals=None, stats=None):
+    if cache is None:
+        cache = buildMaskCache(arrays, ranges)
+    first, last = frameRange if frameRange is not None else (0, int(np.prod(gridShape(ranges))))
+    if blockSize is None:
+        blockSize = max(1, maxBlockCells // (arrays.nDates * arrays.nTickers * len(metrics)))
+
+    meanReturn = np.empty(last - first)
+    meanBeta = np.empty(last - first)
+    blocks = treeBlocks(cache, blockSize, first, last) if tree else flatBlocks(cache, blockSize, first, last)
+    for start, stop, planes in blocks:
+        picks = unpackBits(selectTopBits(planes, cache.validBits), cache.nTickers)
+        periodReturn, periodBeta = periodAverages(arrays, picks)
+        if periodSink is not None:
+            periodSink(start, picks, planeScores(arrays, cache, planes), periodReturn, periodBeta)
+        if totals is not None:
+            totals.add(start, periodReturn, periodBeta)
+        if stats is not None:
+            stats.add(start - first, periodReturn)
+        meanReturn[start-first:stop-first] = nanMean(periodReturn, axis=1)
+        meanBeta[start-first:stop-first] = nanMean(periodBeta, axis=1)
+
+    return meanReturn, meanBeta
+
+#Two thresholds of a metric that no observed value of the sector separates pass exactly the same
+#companies on every date, so every frame built from them picks the same portfolios.
+#classes[x][i] is the equivalence class of the i-th threshold of metric x, and representatives[x]
+#holds the first threshold of each class; only the grid of representatives has to be evaluated.
+class CompiledGrid:
+    def __init__(self, ranges, representatives, classes):
+        self.ranges = ranges
+        self.representatives = representatives
+        self.classes = classes
+        self.nFrames = int(np.prod(gridShape(ranges)))
+        self.nDistinct = int(np.prod(gridShape(representatives)))
+
+    #Frames per distinct frame; 1.0 means nothing could be skipped
+    @property
+    def ratio(self):
+        return self.nFrames / self.nDistinct if self.nDistinct else 1.0
+
+    #Copies per-distinct-frame results (in representative grid order) to every original frame
+    def fanOut(self, values):
+        values = np.asarray(values).reshape(gridShape(self.representatives))
+        return values[np.ix_(*self.classes)].ravel()
+
+    #Representative frame ID of each of frameIds (IDs of the full grid)
+    def representativeIds(self, frameIds):
+        digits = np.unravel_index(np.asarray(frameIds), gridShape(self.ranges))
+        return np.ravel_multi_index([self.classes[x][digits[x]] for x in range(len(digits))], \
+                                    gridShape(self.representatives))
+
+    #Number of frames of the full grid each representative frame stands for
+    def multiplicity(self, representativeIds):
+        digits = np.unravel_index(np.asarray(representativeIds), gridShape(self.representatives))
+        counts = np.ones(np.shape(representativeIds), dtype=np.int64)
+        for x in range(len(digits)):
+            counts *= np.bincount(self.classes[x], minlength=len(self.representatives[x]))[digits[x]]
+        return counts
+
+    #Frame IDs of the full grid that one representative frame stands for, in frame ID order
+    def members(self, representativeId):
+        digits = np.unravel_index(int(representativeId), gridShape(self.representatives))
+        positions = [np.flatnonzero(self.classes[x] == digits[x]) for x in range(len(digits))]
+        return np.ravel_multi_index(np.meshgrid(*positions, indexing='ij'), gridShape(self.ranges)).ravel()
+
+#Maps each metric's candidate thresholds onto the breakpoints between the values the sector
+#actually has.  A low-value metric passes on value < t, so its class is the number of values below
+#t; any other metric passes on value > t, so its class is the number of values at or below t.
+def compileGrid(arrays, ranges):
+    representatives = []
+    classes = []
+    for x in range(len(metrics)):
+        observed = np.sort(arrays.values[:, :, x][arrays.valid])
+        observed = observed[~np.isnan(observed)]
+        thresholds = list(ranges[x])
+        side = 'left' if arrays.signs[x] > 0 else 'right'
+        keys = np.searchsorted(observed, np.asarray(thresholds, dtype=float), side=side)
+        unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        representatives.append([thresholds[i] for i in first])
+        classes.append(inverse.ravel())
+    return CompiledGrid(ranges, representatives, classes)
+
+#evaluateGrid over only one frame per equivalence class, fanned back out to the full grid.
+#Returns meanReturn, meanBeta (in the frame ID order of ranges) and the CompiledGrid.
+#evaluate(arrays, ranges) scores the representative grid; backtest_runner.evaluateSharded can be
+#passed here to spread it over several processes.
+def evaluateDeduplicated(arrays, ranges, evaluate=evaluateGrid):
+    grid = compileGrid(arrays, ranges)
+    meanReturn, meanBeta = evaluate(arrays, grid.representatives)
+    return grid.fanOut(meanReturn), grid.fanOut(meanBeta), grid
+
+#Running totals of every frame of the grid over the dates of arrays, scoring one frame per
+#equivalence class of those dates.  Adding them to the totals of earlier dates updates a run in place.
+def evaluateTotals(arrays, ranges):
+    grid = compileGrid(arrays, ranges)
+    totals = FrameTotals(grid.nDistinct)
+    evaluateGrid(arrays, grid.representatives, totals=totals)
+    return totals.fanOut(grid)
+
+#evaluateDeduplicated that also measures the FrameStats of every frame.  riskFree is the rate of each
+#date of arrays.  Returns meanReturn, meanBeta, the FrameStats and the CompiledGrid.
+#evaluate(arrays, ranges, stats=stats) scores the representative grid, as in evaluateDeduplicated.
+def evaluateWithStats(arrays, ranges, riskFree, evaluate=evaluateGrid):
+    grid = compileGrid(arrays, ranges)
+    stats = FrameStats(grid.nDistinct, riskFree, sectorAverage(arrays))
+    meanReturn, meanBeta = evaluate(arrays, grid.representatives, stats=stats)
+    return grid.fanOut(meanReturn), grid.fanOut(meanBeta), stats.fanOut(grid), grid
+
+#The count best slots of every (frame, date) by score as a boolean mask, with the tie order of
+#selectTopBits (lower slot first).  One partition per (frame, date) finds the cutoff score instead of
+#sorting every ticker, and the places left at the cutoff go to the lowest tied slots, taken from
+#packed bits as selectTopBits does.  Empty slots are never picked.
+def selectTopScores(scores, valid, count):
+    if scores.shape[2] <= count:
+        return np.broadcast_to(valid, scores.shape).copy()
+    cutoff = -np.partition(-scores, count - 1, axis=2)[:, :, count-1:count]
+    above = scores > cutoff
+    tied = packBits(scores == cutoff)
+    counts = popcount(tied).astype(np.int32)
+    before = np.cumsum(counts, axis=2) - counts
+    keep = np.clip(count - above.sum(axis=2, keepdims=True, dtype=np.int32) - before, 0, counts)
+    chosen = packBits(above) | np.where(keep >= counts, tied, lowestBits(tied, keep, count))
+    return unpackBits(chosen & packBits(valid), scores.shape[2]).astype(bool)
+
+#Slots of the picks of every (frame, date) in pick order (score descending, lower slot first), as a
+#(frames x dates x count) array with -1 after the last pick.  Only the picks are sorted.
+def pickOrder(scores, picks, count):
+    f, d, t = np.nonzero(picks)
+    row = f * picks.shape[1] + d
+    first = np.flatnonzero(np.concatenate(([True], row[1:] != row[:-1])))
+    position = np.arange(len(row)) - np.repeat(first, np.diff(np.append(first, len(row))))
+    slots = np.full(picks.shape[:2] + (count,), -1, dtype=np.int64)
+    slots[f, d, position] = t
+    picked = np.where(slots >= 0, np.take_along_axis(scores, np.maximum(slots, 0), axis=2), -np.inf)
+    return np.take_along_axis(slots, np.argsort(-picked, axis=2, kind='stable'), axis=2)
+
+#Period averages of the best companies of every (frame, date) for several portfolio sizes from one
+#ranking.  slots holds the top max(sizes) companies in pick order (see pickOrder), and prefix sums of
+#RETURN and ADJUSTED_BETA along them give the averages of every size together.  A date with fewer
+#companies than a size averages all of them, as iloc[0:5] does.
+#Returns periodReturn and periodBeta of shape (frames x dates x sizes).
+def rankedAverages(arrays, slots, sizes):
+    dates = np.arange(arrays.nDates)[np.newaxis, :, np.newaxis]
+    have = slots >= 0
+    cumReturn = np.cumsum(np.where(have, arrays.returns[dates, np.maximum(slots, 0)], 0), axis=2)
+    cumBeta = np.cumsum(np.where(have, arrays.betas[dates, np.maximum(slots, 0)], 0), axis=2)
+    counts = np.minimum(np.asarray(sizes)[np.newaxis, :], arrays.valid.sum(axis=1)[:, np.newaxis])
+    last = np.broadcast_to(np.maximum(counts - 1, 0), (len(slots),) + counts.shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        periodReturn = np.take_along_axis(cumReturn, last, axis=2) / counts
+        periodBeta = np.take_along_axis(cumBeta, last, axis=2) / counts + betaOffset
+    return periodReturn, periodBeta
+
+#meanReturn and meanBeta of every frame of the grid for every portfolio size in sizes, as
+#(frames x sizes) arrays, from a single scoring and ranking pass over the deduplicated grid: the top
+#max(sizes) companies are taken with selectTopBits and only they are put in pick order.
+#Returns them with the CompiledGrid.
+def evaluateSizeSweep(arrays, ranges, sizes, blockSize=None):
+    grid = compileGrid(arrays, ranges)
+    cache = buildMaskCache(arrays, grid.representatives)
+    if blockSize is None:
+        blockSize = max(1, maxBlockCells // (arrays.nDates * arrays.nTickers * len(metrics)))
+
+    meanReturn = np.empty((grid.nDistinct, len(sizes)))
+    meanBeta = np.empty((grid.nDistinct, len(sizes)))
+    for start, stop, planes in treeBlocks(cache, blockSize, 0, grid.nDistinct):
+        picks = unpackBits(selectTopBits(planes, cache.validBits, max(sizes)), cache.nTickers).astype(bool)
+        slots = pickOrder(planeScores(arrays, cache, planes), picks, max(sizes))
+        periodReturn, periodBeta = rankedAverages(arrays, slots, sizes)
+        meanReturn[start:stop] = nanMean(periodReturn, axis=1)
+        meanBeta[start:stop] = nanMean(periodBeta, axis=1)
+
+    meanReturn = np.stack([grid.fanOut(meanReturn[:, k]) for k in range(len(sizes))], axis=1)
+    meanBeta = np.stack([grid.fanOut(meanBeta[:, k]) for k in range(len(sizes))], axis=1)
+    return meanReturn, meanBeta, grid
+
+#Pass masks of a block of frames given as threshold indices (frames x 7), unpacked from the cache into
+#(frames x dates x tickers x 7) booleans
+def cachedPasses(cache, indices):
+    return np.stack([unpackBits(cache.masks[x][indices[:, x]], cache.nTickers) for x in range(len(metrics))], axis=3)
+
+#Weighted hsf scores of every (frame, date, ticker) under every weight set, as one matrix product of
+#the pass masks with the (sets x 7) weights: (frames x dates x tickers x sets).  Empty slots get -inf.
+def weightedScores(arrays, passes, weights):
+    scores = passes.reshape(-1, len(metrics)).astype(np.float32) @ weights.T
+    scores = scores.reshape(passes.shape[:3] + (len(weights),))
+    scores[:, ~arrays.valid] = -np.inf
+    return scores
+
+#Every combination of the candidate weights of each metric, as a (sets x 7) array of weight sets
+def weightGrid(choices):
+    return np.array(list(product(*choices)), dtype=np.float32).reshape(-1, len(metrics))
+
+#meanReturn and meanBeta of every frame of the grid with the hsf score weighted per metric, for every
+#weight set in weights (sets x 7, or one vector) and every portfolio size in sizes, as (frames x sets
+#x sizes) arrays.  Each block is scored for all weight sets by weightedScores; for every weight set the
+#best max(sizes) companies are found by selectTopScores and only they are ranked.  Weights of 1 give the usual hsf score.  Returns them with the
+#CompiledGrid.
+def evaluateWeighted(arrays, ranges, weights, sizes=(portfolioSize,), blockSize=None):
+    weights = np.atleast_2d(np.asarray(weights, dtype=np.float32))
+    grid = compileGrid(arrays, ranges)
+    cache = buildMaskCache(arrays, grid.representatives)
+    shape = gridShape(grid.representatives)
+    if blockSize is None:
+        blockSize = max(1, maxBlockCells // (arrays.nDates * arrays.nTickers * (len(metrics) + len(weights) * len(sizes))))
+
+    meanReturn = np.empty((grid.nDistinct, len(weights), len(sizes)))
+    meanBeta = np.empty((grid.nDistinct, len(weights), len(sizes)))
+    for start in range(0, grid.nDistinct, blockSize):
+        stop = min(start + blockSize, grid.nDistinct)
+        indices = np.stack(np.unravel_index(np.arange(start, stop), shape), axis=1)
+        scores = weightedScores(arrays, cachedPasses(cache, indices), weights)
+        scores = np.moveaxis(scores, 3, 1).reshape(-1, arrays.nDates, arrays.nTickers)
+        picks = selectTopScores(scores, arrays.valid, max(sizes))
+        periodReturn, periodBeta = rankedAverages(arrays, pickOrder(scores, picks, max(sizes)), sizes)
+        meanReturn[start:stop] = nanMean(periodReturn, axis=1).reshape(stop - start, len(weights), len(sizes))
+        meanBeta[start:stop] = nanMean(periodBeta, axis=1).reshape(stop - start, len(weights), len(sizes))
+
+    representatives = grid.representativeIds(np.arange(grid.nFrames))
+    return meanReturn[representatives], meanBeta[representatives], grid
+
+#The best frames of a grid by objective ('totalTreynor' or 'meanReturn'), without keeping the grid:
+#the representative grid is scored chunkFrames frames at a time and each chunk is pushed to the
+#leaderboard with the number of frames each representative stands for.  evaluate, if given, scores
+#the whole representative grid at once instead (e.g. backtest_runner.evaluateSharded).
+#Returns the CompiledGrid, which leaderboard.toDataFrame needs to turn representatives into frames.
+def evaluateLeaderboard(arrays, ranges, leaderboard, evaluate=None, chunkFrames=1 << 20):
+    grid = compileGrid(arrays, ranges)
+    if evaluate is None:
+        cache = buildMaskCache(arrays, grid.representatives)
+        for first in range(0, grid.nDistinct, chunkFrames):
+            last = min(first + chunkFrames, grid.nDistinct)
+            meanReturn, meanBeta = evaluateGrid(arrays, grid.representatives, cache=cache, frameRange=(first, last))
+            frameIds = np.arange(first, last)
+            leaderboard.push(frameIds, meanReturn, meanBeta, grid.multiplicity(frameIds))
+    else:
+        meanReturn, meanBeta = evaluate(arrays, grid.representatives)
+        frameIds = np.arange(grid.nDistinct)
+        leaderboard.push(frameIds, meanReturn, meanBeta, grid.multiplicity(frameIds))
+    return grid
+
+#Risk-free rate of every date under every scenario, as scenario names and a (dates x scenarios)
+#table of fractions.  rates is a rate in percent, a pandas Series of rates in percent by date (a date
+#takes the latest rate on or before it, or the first rate if it comes before the series) or a dict of
+#named scenarios of either.
+def riskFreeTable(dates, rates):
+    scenarios = rates if isinstance(rates, dict) else {'base': rates}
+    table = np.empty((len(dates), len(scenarios)))
+    for s, rate in enumerate(scenarios.values()):
+        if isinstance(rate, pd.Series):
+            rate = rate.sort_index()
+            table[:, s] = rate.reindex(rate.index.union(dates)).ffill().bfill().reindex(dates).to_numpy() / 100
+        else:
+            table[:, s] = rate / 100
+    return list(scenarios), table
+
+#Mean risk-free rate of each scenario over the dates where a sector has companies.  Every frame holds
+#a portfolio on exactly those dates, so (meanReturn - rate) / meanBeta is each frame's mean excess
+#return over beta, and one scoring pass gives totalTreynor under every scenario.
+def meanRiskFree(table, present):
+    rates = table[present]
+    if len(rates) == 0:
+        return table[0] if len(table) else np.full(table.shape[1], np.nan)
+    return np.where(rates.min(axis=0) == rates.max(axis=0), rates[0], rates.mean(axis=0))
+
+#Adds a totalTreynor column per scenario ({name: mean rate}) to a dfTotalPort table
+def addScenarioColumns(df, scenarios):
+    for name, rate in scenarios.items():
+        df['totalTreynor_' + name] = (df['meanReturn'] - rate) / df['meanBeta']
+    return df
+
+#Frame IDs number the frames of a grid in the order product() yields them, as a mixed-radix integer
+#whose digits are the position of each threshold in its range (roaRange is the lowest digit)
+def gridShape(ranges):
+    return tuple(len(r) for r in ranges)
+
+#Threshold tuple -> frame ID
+def encodeFrame(frame, ranges):
+    digits = [list(ranges[x]).index(frame[x]) for x in range(len(ranges))]
+    return int(np.ravel_multi_index(digits, gridShape(ranges)))
+
+#Frame ID -> threshold tuple
+def decodeFrame(frameId, ranges):
+    digits = np.unravel_index(frameId, gridShape(ranges))
+    return tuple(ranges[x][int(digits[x])] for x in range(len(ranges)))
+
+#Array of frame IDs -> (frames x 7) array of thresholds
+def decodeFrames(frameIds, ranges):
+    digits = np.unravel_index(np.asarray(frameIds), gridShape(ranges))
+    return np.stack([np.asarray(list(ranges[x]))[digits[x]] for x in range(len(ranges))], axis=1)
+
+#Readable frame label such as T13_2_4_60_25_12_5.  The thresholds are separated so labels never clash.
+#An empty grid (a range with no thresholds) has no labels.
+def frameIdentifiers(tests):
+    tests = pd.DataFrame(tests)
+    if tests.empty:
+        return np.array([], dtype=object)
+    labels = "T" + tests[0].map(str)
+    for x in range(1, tests.shape[1]):
+        labels = labels + "_" + tests[x].map(str)
+    return labels.values
+
+#Per-frame results of one sector held in typed arrays indexed by frame ID, so recording a frame is
+#a constant-time array write.  dfTotalPort is only built from it at the end of a run.
+class FrameResults:
+    def __init__(self, ranges):
+        self.ranges = [r for r in ranges]
+        self.shape = gridShape(ranges)
+        self.nFrames = int(np.prod(self.shape))
+        self.meanReturn = np.full(self.nFrames, np.nan)
+        self.meanBeta = np.full(self.nFrames, np.nan)
+        self.evaluated = np.zeros(self.nFrames, dtype=bool)
+
+    #frameIds can be a single ID, an array of IDs or a slice
+    def record(self, frameIds, meanReturn, meanBeta):
+        self.meanReturn[frameIds] = meanReturn
+        self.meanBeta[frameIds] = meanBeta
+        self.evaluated[frameIds] = True
+
+    def tests(self, frameIds=None):
+        if frameIds is None:
+            frameIds = np.arange(self.nFrames)
+        return decodeFrames(frameIds, self.ranges)
+
+    #Lowest frame ID not evaluated yet (nFrames when every frame is done)
+    def firstUnfinished(self):
+        missing = np.flatnonzero(~self.evaluated)
+        return int(missing[0]) if len(missing) else self.nFrames
+
+    #Writes the results so far to path.  key identifies the data and configuration of the run; the
+    #file is written next to path first and then renamed, so a crash never leaves half a checkpoint.
+    def saveCheckpoint(self, path, key):
+        temporary = path + ".tmp.npz"
+        np.savez(temporary, key=np.array(key), shape=np.array(self.shape), meanReturn=self.meanReturn, \
+                 meanBeta=self.meanBeta, evaluated=self.evaluated)
+        os.replace(temporary, path)
+
+    #Restores results from a checkpoint written by saveCheckpoint.  Returns False and leaves the
+    #results untouched if there is no checkpoint or it belongs to a different key or grid.
+    def loadCheckpoint(self, path, key):
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as saved:
+            if str(saved['key']) != key or tuple(saved['shape']) != self.shape:
+                return False
+            self.meanReturn[:] = saved['meanReturn']
+            self.meanBeta[:] = saved['meanBeta']
+            self.evaluated[:] = saved['evaluated']
+        return True
+
+    #Builds the dfTotalPort table (one row per frame, in frame ID order), with a totalTreynor column per
+    #scenario if scenarios ({name: mean rate}) is given and the columns of a FrameStats if stats is
+    def toDataFrame(self, tBill, scenarios=None, stats=None):
+        tests = self.tests()
+        df = pd.DataFrame({'frameId': np.arange(self.nFrames)}, index=frameIdentifiers(tests))
+        df['meanReturn'] = self.meanReturn
+        df['meanBeta'] = self.meanBeta
+        df['tBill3Mth'] = tBill
+        df['totalTreynor'] = (self.meanReturn - tBill) / self.meanBeta
+        for x in range(len(dfTests)):
+            df[dfTests[x]] = tests[:, x]
+        if stats is not None:
+            for name in statColumns:
+                df[name] = stats.columns[name]
+        return addScenarioColumns(df, scenarios or {})
+
+#Equal-weight average return of all the sector's companies on each date (NaN on dates without any)
+def sectorAverage(arrays):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (arrays.returns * arrays.valid).sum(axis=1) / arrays.valid.sum(axis=1)
+
+#Performance of every frame beyond its mean return and beta, measured from the period returns of each
+#block while the grid is scored, so no per-period output has to be read back.  Returns are taken per
+#period, in the same units as the risk-free rates.  Over the dates where a frame holds a portfolio:
+#  sharpe        mean excess return over the risk-free rate / its standard deviation
+#  sortino       mean excess return / root mean square of the negative excess returns
+#  hitRate       share of dates the portfolio beats the sector's equal-weight average
+#  maxDrawdown   largest fall from a peak of the compounded path, prod(1 + return), as a fraction
+#  excessReturn  mean return above the sector's equal-weight average
+statColumns = ['sharpe', 'sortino', 'hitRate', 'maxDrawdown', 'excessReturn']
+
+class FrameStats:
+    def __init__(self, nFrames, riskFree, benchmark):
+        self.nFrames = nFrames
+        self.riskFree = riskFree
+        self.benchmark = benchmark
+        self.columns = {name: np.full(nFrames, np.nan, dtype=np.float32) for name in statColumns}
+
+    #Measures the (frames x dates) period returns of frames first, first+1, ...
+    def add(self, first, periodReturn):
+        stop = first + len(periodReturn)
+        have = ~np.isnan(periodReturn)
+        count = have.sum(axis=1)
+        excess = np.where(have, periodReturn - self.riskFree, 0)
+        active = np.where(have, periodReturn - self.benchmark, 0)
+        wealth = np.cumprod(1 + np.where(have, periodReturn, 0), axis=1)
+        peak = np.maximum(np.maximum.accumulate(wealth, axis=1), 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            meanExcess = excess.sum(axis=1) / count
+            spread = np.sqrt(((excess - meanExcess[:, np.newaxis]) ** 2 * have).sum(axis=1) / (count - 1))
+            downside = np.sqrt((np.minimum(excess, 0) ** 2).sum(axis=1) / count)
+            self.columns['sharpe'][first:stop] = meanExcess / spread
+            self.columns['sortino'][first:stop] = meanExcess / downside
+            self.columns['hitRate'][first:stop] = ((active > 0) & have).sum(axis=1) / count
+            self.columns['maxDrawdown'][first:stop] = (1 - wealth / peak).max(axis=1, initial=0)
+            self.columns['excessReturn'][first:stop] = active.sum(axis=1) / count
+
+    #Stats of a CompiledGrid's representatives copied to every frame of the full grid
+    def fanOut(self, grid):
+        stats = FrameStats(grid.nFrames, self.riskFree, self.benchmark)
+        stats.columns = {name: grid.fanOut(values) for name, values in self.columns.items()}
+        return stats
+
+#Per-frame sums and counts of the period averages over the dates scored so far.  meanReturn and
+#meanBeta are nanMean over those dates, so a run can be carried forward by adding the totals of new
+#dates instead of scoring every date again, and a date whose data was restated can be corrected by
+#removing the totals of its old rows and adding those of the new.  save/load keep them with the grid
+#and the vintage of the data they cover, a dict of arrays (see backtest_data.sectorManifest).
+class FrameTotals:
+    def __init__(self, nFrames):
+        self.nFrames = nFrames
+        self.sumReturn = np.zeros(nFrames)
+        self.sumBeta = np.zeros(nFrames)
+        self.countReturn = np.zeros(nFrames, dtype=np.int64)
+        self.countBeta = np.zeros(nFrames, dtype=np.int64)
+
+    #Adds the (frames x dates) period averages of frames first, first+1, ...
+    def add(self, first, periodReturn, periodBeta):
+        stop = first + len(periodReturn)
+        for total, count, values in ((self.sumReturn, self.countReturn, periodReturn), \
+                                     (self.sumBeta, self.countBeta, periodBeta)):
+            have = ~np.isnan(values)
+            total[first:stop] += np.where(have, values, 0).sum(axis=1)
+            count[first:stop] += have.sum(axis=1)
+
+    #Adds the totals of the same frames over other dates
+    def merge(self, other):
+        self.sumReturn += other.sumReturn
+        self.sumBeta += other.sumBeta
+        self.countReturn += other.countReturn
+        self.countBeta += other.countBeta
+
+    #Takes away the totals of the same frames over other dates
+    def remove(self, other):
+        self.sumReturn -= other.sumReturn
+        self.sumBeta -= other.sumBeta
+        self.countReturn -= other.countReturn
+        self.countBeta -= other.countBeta
+
+    #Totals of a CompiledGrid's representatives copied to every frame of the full grid
+    def fanOut(self, grid):
+        totals = FrameTotals(grid.nFrames)
+        totals.sumReturn = grid.fanOut(self.sumReturn)
+        totals.sumBeta = grid.fanOut(self.sumBeta)
+        totals.countReturn = grid.fanOut(self.countReturn)
+        totals.countBeta = grid.fanOut(self.countBeta)
+        return totals
+
+    @property
+    def meanReturn(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sumReturn / self.countReturn
+
+    @property
+    def meanBeta(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sumBeta / self.countBeta
+
+    #Written next to path first and then renamed, like FrameResults.saveCheckpoint
+    def save(self, path, key, ranges, vintage):
+        temporary = path + ".tmp.npz"
+        saved = {'range%d' % x: np.asarray(list(ranges[x]), dtype=np.int64) for x in range(len(ranges))}
+        saved.update({'vintage.' + name: values for name, values in vintage.items()})
+        np.savez(temporary, key=np.array(key), sumReturn=self.sumReturn, sumBeta=self.sumBeta, \
+                 countReturn=self.countReturn, countBeta=self.countBeta, **saved)
+        os.replace(temporary, path)
+
+#Returns (totals, ranges, vintage) saved by FrameTotals.save under key, or None
+def loadTotals(path, key):
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        if str(saved['key']) != key:
+            return None
+        totals = FrameTotals(len(saved['sumReturn']))
+        totals.sumReturn[:] = saved['sumReturn']
+        totals.sumBeta[:] = saved['sumBeta']
+        totals.countReturn[:] = saved['countReturn']
+        totals.countBeta[:] = saved['countBeta']
+        ranges = [saved['range%d' % x].tolist() for x in range(len(metrics))]
+        vintage = {name[len('vintage.'):]: saved[name] for name in saved.files if name.startswith('vintage.')}
+        return totals, ranges, vintage
+
+#The best size frames of a run by objective ('totalTreynor' or 'meanReturn'), kept while blocks of
+#results arrive, so memory and the final sort depend on size rather than on the number of frames.
+#push takes frame IDs with their results; weights says how many frames each ID stands for (one
+#representative frame of a CompiledGrid stands for all its members).  Frames that fall off the board
+#are only counted: seen, missing (no objective) and, if histogram edges are given, a histogram of
+#the objective.  Ties go to the lowest ID pushed.
+class Leaderboard:
+    def __init__(self, size, tBill, objective='totalTreynor', edges=None):
+        self.size = size
+        self.tBill = tBill
+        self.objective = objective
+        self.edges = edges
+        self.frameIds = np.empty(0, dtype=np.int64)
+        self.meanReturn = np.empty(0)
+        self.meanBeta = np.empty(0)
+        self.weights = np.empty(0, dtype=np.int64)
+        self.seen = 0
+        self.missing = 0
+        self.histogram = None if edges is None else np.zeros(len(edges) - 1, dtype=np.int64)
+
+    def score(self, meanReturn, meanBeta):
+        if self.objective == 'meanReturn':
+            return meanReturn
+        return (meanReturn - self.tBill) / meanBeta
+
+    def push(self, frameIds, meanReturn, meanBeta, weights=None):
+        frameIds = np.asarray(frameIds, dtype=np.int64)
+        weights = np.ones(len(frameIds), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+        score = self.score(meanReturn, meanBeta)
+        present = ~np.isnan(score)
+        self.seen += int(weights.sum())
+        self.missing += int(weights[~present].sum())
+        if self.histogram is not None:
+            self.histogram += np.histogram(score[present], self.edges, weights=weights[present])[0].astype(np.int64)
+
+        #Only the size best IDs of the block can reach the board, since each stands for at least one frame
+        if present.sum() > self.size:
+            cut = np.partition(score[present], present.sum() - self.size)[present.sum() - self.size]
+            present &= score >= cut
+        frameIds = np.concatenate((self.frameIds, frameIds[present]))
+        meanReturn = np.concatenate((self.meanReturn, meanReturn[present]))
+        meanBeta = np.concatenate((self.meanBeta, meanBeta[present]))
+        weights = np.concatenate((self.weights, weights[present]))
+
+        order = np.lexsort((frameIds, -self.score(meanReturn, meanBeta)))
+        order = order[np.cumsum(weights[order]) - weights[order] < self.size]
+        self.frameIds = frameIds[order]
+        self.meanReturn = meanReturn[order]
+        self.meanBeta = meanBeta[order]
+        self.weights = weights[order]
+
+    #Frames seen, frames without an objective and frames kept on the board
+    def summary(self):
+        return {'seen': self.seen, 'missing': self.missing, 'kept': min(int(self.weights.sum()), self.size)}
+
+    #The board as dfTotalPort rows, best first.  grid is the CompiledGrid of evaluateLeaderboard when
+    #the board holds representative frames; ranges is the grid the frame IDs refer to.  scenarios
+    #({name: mean rate}) adds their totalTreynor columns, as FrameResults.toDataFrame does.
+    def toDataFrame(self, ranges, grid=None, scenarios=None):
+        frameIds, rows = self.frameIds, np.arange(len(self.frameIds))
+        if grid is not None:
+            members = [grid.members(frameId) for frameId in self.frameIds]
+            frameIds = np.concatenate(members + [np.empty(0, dtype=np.int64)])
+            rows = np.repeat(rows, [len(m) for m in members])
+        frameIds, rows = frameIds[:self.size], rows[:self.size]
+        tests = decodeFrames(frameIds, ranges)
+        df = pd.DataFrame({'frameId': frameIds}, index=frameIdentifiers(tests))
+        df['meanReturn'] = self.meanReturn[rows]
+        df['meanBeta'] = self.meanBeta[rows]
+        df['tBill3Mth'] = self.tBill
+        df['totalTreynor'] = (df['meanReturn'] - self.tBill) / df['meanBeta']
+        for x in range(len(dfTests)):
+            df[dfTests[x]] = tests[:, x]
+        return addScenarioColumns(df, scenarios or {})
@@ -0,0 +1,215 @@
+#Columnar output for the HSF backtest.
+#The per-period and per-portfolio sheets are collected in memory and written as compressed columnar
+#chunks (numpy .npz, or Parquet when pyarrow is installed), one directory per sector run and one file
+#per block of frames, instead of appending a CSV block with its own header for every frame.
+import os
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from backtest_engine import dfTests, dfScores, decodeFrames, frameIdentifiers
+
+#Rows collected for a sheet before a chunk is written
+rowsPerChunk = 1000000
+
+fileExtensions = {'npz': '.npz', 'parquet': '.parquet'}
+
+#Turns a dataframe into typed numpy columns.  Object columns become numbers when they hold numbers
+#(the summary sheets start their columns as None) and fixed-width strings otherwise.
+def typedColumns(df):
+    columns = {}
+    for col in df.columns:
+        values = df[col].to_numpy()
+        if values.dtype == object:
+            try:
+                values = pd.to_numeric(df[col]).to_numpy()
+            except (ValueError, TypeError):
+                values = df[col].to_numpy(dtype=str)
+            if values.dtype == object:
+                values = df[col].to_numpy(dtype=str)
+        columns[str(col)] = values
+    return columns
+
+def writeTable(df, path, format):
+    if format == 'parquet':
+        df.to_parquet(path, compression='zstd', index=False)
+    else:
+        np.savez_compressed(path, **typedColumns(df))
+    return os.path.getsize(path)
+
+def appendTable(df, path, options):
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    df.to_csv(path, mode='a', **options)
+    return os.path.getsize(path) - size
+
+def readTable(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    with np.load(path) as saved:
+        return pd.DataFrame({col: saved[col] for col in saved.files})
+
+#Collects rows per sheet ("kind") and writes a chunk file once rowsPerChunk rows are waiting.
+#Files are named after the first and last frameId they contain and a chunk number,
+#e.g. IndPortPeriod/frames-0-4095-00000.npz
+#Chunks left in a sheet's folder by an earlier run are removed when the sheet is first written.
+class ResultsWriter:
+    def __init__(self, directory, format='npz', rowsPerChunk=rowsPerChunk):
+        self.directory = directory
+        self.format = format
+        self.rowsPerChunk = rowsPerChunk
+        self.pending = {}
+        self.pendingRows = {}
+        self.chunks = {}
+        self.bytesWritten = 0
+
+    #Adds the rows of df to a sheet.  A non-default index (such as DATE) is kept as a column.
+    def append(self, kind, df):
+        if not isinstance(df.index, pd.RangeIndex):
+            df = df.reset_index()
+        self.pending.setdefault(kind, []).append(df)
+        self.pendingRows[kind] = self.pendingRows.get(kind, 0) + len(df)
+        if self.pendingRows[kind] >= self.rowsPerChunk:
+            self.flush(kind)
+
+    #Writes the waiting rows of one sheet, or of every sheet when kind is None
+    def flush(self, kind=None):
+        kinds = list(self.pending) if kind is None else [kind]
+        for k in kinds:
+            frames = self.pending.pop(k, [])
+            self.pendingRows[k] = 0
+            if not frames:
+                continue
+            self.writeChunk(k, pd.concat(frames, ignore_index=True))
+
+    def writeChunk(self, kind, df):
+        self.bytesWritten += writeTable(df, self.chunkPath(kind, df), self.format)
+
+    #Appends df to a CSV sheet at path, with its own header block as prod() has always written them.
+    #options are passed on to to_csv.
+    def appendCSV(self, path, df, **options):
+        self.bytesWritten += appendTable(df, path, options)
+
+    #Path of the next chunk of a sheet
+    def chunkPath(self, kind, df):
+        folder = os.path.join(self.directory, kind)
+        number = self.chunks.get(kind, 0)
+        if number == 0:
+            os.makedirs(folder, exist_ok=True)
+            for name in os.listdir(folder):
+                if name.endswith(tuple(fileExtensions.values())):
+                    os.remove(os.path.join(folder, name))
+        self.chunks[kind] = number + 1
+        if 'frameId' in df.columns and len(df):
+            name = "frames-%d-%d-%05d" % (df['frameId'].min(), df['frameId'].max(), number)
+        else:
+            name = "part-%05d" % number
+        return os.path.join(folder, name + fileExtensions[self.format])
+
+    def status(self):
+        return {'queueDepth': 0, 'bytesWritten': self.bytesWritten}
+
+    def close(self):
+        self.flush()
+
+#ResultsWriter whose chunks are compressed and written, and whose CSV appends are made, by a background
+#thread, so scoring carries on while files are written.  Writes are made in the order they are queued.
+#At most maxQueued writes wait in the queue; when it is full, append and appendCSV block until the
+#writer catches up, which bounds the memory held by pending output.
+class BackgroundWriter(ResultsWriter):
+    def __init__(self, directory, format='npz', rowsPerChunk=rowsPerChunk, maxQueued=4):
+        ResultsWriter.__init__(self, directory, format, rowsPerChunk)
+        self.queue = queue.Queue(maxsize=maxQueued)
+        self.error = None
+        self.thread = threading.Thread(target=self.writeLoop, daemon=True)
+        self.thread.start()
+
+    def writeLoop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            write, args = item
+            try:
+                if self.error is None:
+                    self.bytesWritten += write(*args)
+            except Exception as e:
+                self.error = e
+
+    def put(self, write, *args):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((write, args))
+
+    def writeChunk(self, kind, df):
+        self.put(writeTable, df, self.chunkPath(kind, df), self.format)
+
+    def appendCSV(self, path, df, **options):
+        self.put(appendTable, df, path, options)
+
+    #Chunks waiting to be written and bytes written so far
+    def status(self):
+        return {'queueDepth': self.queue.qsize(), 'bytesWritten': self.bytesWritten}
+
+    #Writes everything still pending and waits for the writer thread to finish
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+#Loads every chunk of one sheet written by ResultsWriter into a single dataframe
+def loadResults(directory, kind):
+    folder = os.path.join(directory, kind)
+    if not os.path.isdir(folder):
+        return pd.DataFrame()
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder) \
+                   if name.endswith(tuple(fileExtensions.values())))
+    tables = [readTable(path) for path in paths]
+    if not tables:
+        return pd.DataFrame()
+    df = pd.concat(tables, ignore_index=True)
+    if 'frameId' in df.columns:
+        df.sort_values('frameId', kind='stable', inplace=True, ignore_index=True)
+    return df
+
+#Rows of the companies chosen on every (frame, date) of an engine block for the IndPortPeriod sheet,
+#with the same columns as prod() writes: the panel's rows (ticker, sector, metrics, beta and return),
+#the frame's thresholds and tests, betaScore, hsfScore, the frame label and frameId.  Each (frame, date)
+#lists its companies best score first, ties in slot order, like calculatePortLoop's stable sort.
+def periodTable(panel, sector, arrays, ranges, start, picks, hsfScore):
+    f, d, t = np.nonzero(picks)
+    order = np.lexsort((t, -hsfScore[f, d, t], d, f))
+    f, d, t = f[order], d[order], t[order]
+    frames = decodeFrames(start + f, ranges)
+    df = panel.takeRows(sector, arrays.rowIds[d, t], arrays.dates[d])
+    df = df.reset_index(drop=True).set_index(pd.DatetimeIndex(arrays.dates[d], name='DATE'))
+    for x in range(len(dfTests)):
+        df[dfTests[x]] = frames[:, x]
+    for x in range(len(dfScores)):
+        df[dfScores[x]] = arrays.values[d, t, x] * arrays.signs[x] < frames[:, x] * arrays.signs[x]
+    df['betaScore'] = 1 / (df['ADJUSTED_BETA'] * 1000)
+    df['hsfScore'] = hsfScore[f, d, t]
+    df['ind'] = frameIdentifiers(frames)
+    df['frameId'] = start + f
+    return df
+
+#Portfolio averages of every (frame, date) of an engine block for the PortfolioAvgsPerPeriod sheet, with
+#the same columns and dtypes as prod() writes: return, beta, the date's tBill3Mth, treynor, the frame's
+#tests, maxHSFScore, the frame label and frameId.  Dates where the sector has no companies have NaN
+#tests and maxHSFScore.  tBill is one rate or a rate per date.
+def portfolioTable(arrays, ranges, start, picks, hsfScore, periodReturn, periodBeta, tBill):
+    nFrames, nDates = periodReturn.shape
+    frames = decodeFrames(start + np.arange(nFrames), ranges)
+    present = np.tile(arrays.valid.any(axis=1), nFrames)
+    df = pd.DataFrame({'return': periodReturn.ravel(),
+                       'beta': periodBeta.ravel(),
+                       'tBill3Mth': np.tile(np.broadcast_to(np.asarray(tBill, dtype=np.float64), (nDates,)), nFrames),
+                       'treynor': ((periodReturn - tBill) / periodBeta).ravel()},
+                      index=pd.DatetimeIndex(np.tile(arrays.dates.values, nFrames), name='DATE'))
+    for x in range(len(dfTests)):
+        df[dfTests[x]] = np.where(present, np.repeat(frames[:, x], nDates), np.nan)
+    df['maxHSFScore'] = np.where(present, np.where(picks, hsfScore, -1).max(axis=2).ravel(), np.nan)
+    df['ind'] = np.repeat(frameIdentifiers(frames), nDates)
+    df['frameId'] = np.repeat(start + np.arange(nFrames), nDates)
+    return df
@@ -0,0 +1,171 @@
+#Threshold ranges for the HSF backtest.
+#Every sector's values of every metric are sorted once, and all percentiles 0..100 of every
+#(sector, metric) are taken from the sorted values in one vectorized pass.  The result is a range plan
+#that getRanges reads instead of slicing the ranges frame and calling np.percentile per metric.
+import os
+import numpy as np
+import pandas as pd
+from backtest_engine import metrics
+
+#Percentiles kept in the plan's table
+planPercentiles = np.arange(101)
+
+#Linear interpolation between a and b at weights t as np.percentile does it for a single q: the
+#position and weights are float64 and are rounded to the dtype of the values only when applied,
+#so plan percentiles are equal to np.percentile, not just close to it
+def lerp(a, b, t):
+    diff = b - a
+    return np.where(t >= 0.5, b - diff * (1 - t).astype(a.dtype), a + diff * t.astype(a.dtype))
+
+#Percentiles q (in 0..100) of groups laid out one after another in sortedValues,
+#group g being sortedValues[offsets[g]:offsets[g+1]].  Empty groups give NaN.
+def groupPercentiles(sortedValues, offsets, q):
+    sizes = np.diff(offsets)
+    position = np.maximum(sizes - 1, 0)[:, np.newaxis] * (np.asarray(q, dtype=np.float64) / 100)[np.newaxis, :]
+    low = np.floor(position).astype(np.int64)
+    high = np.minimum(low + 1, np.maximum(sizes - 1, 0)[:, np.newaxis])
+    padded = np.append(sortedValues, np.array([np.nan], dtype=sortedValues.dtype))
+    empty = (sizes == 0)[:, np.newaxis]
+    lowValues = padded[np.where(empty, len(sortedValues), offsets[:-1, np.newaxis] + low)]
+    highValues = padded[np.where(empty, len(sortedValues), offsets[:-1, np.newaxis] + high)]
+    return lerp(lowValues, highValues, position - low)
+
+#sortedValues[m] holds the non-missing values of metric m sorted by sector and then by value, with
+#sector s at sortedValues[m][offsets[m][s]:offsets[m][s+1]].  table[s, m, q] is percentile q of
+#metric m in sector s, or NaN if the sector has no values of that metric.
+class RangePlan:
+    def __init__(self, sectors, sortedValues, offsets, table):
+        self.sectors = list(sectors)
+        self.sortedValues = sortedValues
+        self.offsets = offsets
+        self.table = table
+        self.sectorCodes = {name: i for i, name in enumerate(self.sectors)}
+
+    def values(self, sector, metric):
+        m = metrics.index(metric)
+        s = self.sectorCodes[sector]
+        return self.sortedValues[m][self.offsets[m][s]:self.offsets[m][s+1]]
+
+    #Percentile q of a metric in a sector; whole percentiles come from the table
+    def percentile(self, sector, metric, q):
+        if float(q).is_integer() and 0 <= q <= 100:
+            return self.table[self.sectorCodes[sector], metrics.index(metric), int(q)]
+        values = self.values(sector, metric)
+        return groupPercentiles(values, np.array([0, len(values)]), [q])[0, 0]
+
+    #Reverse lookup: the share (in percent) of a sector's values of a metric that are below value
+    def percentileOf(self, sector, metric, value):
+        values = self.values(sector, metric)
+        return 100.0 * np.searchsorted(values, value, side='left') / max(len(values), 1)
+
+    #Threshold range of a metric in a sector: from percentile low to percentile high in steps of step
+    def range(self, sector, metric, step, low=34, high=68):
+        return range(int(round(self.percentile(sector, metric, low))), \
+                     int(round(self.percentile(sector, metric, high))), step)
+
+    #Thresholds of a metric within the low..high band of a sector that fit count values: either the
+    #band's whole numbers in equal steps ('steps', like getNormal) or whole numbers at equally spaced
+    #percentiles of the band ('percentiles', denser where the sector's values are)
+    def bandThresholds(self, sector, metric, count, spacing='steps', low=34, high=68):
+        start = int(round(self.percentile(sector, metric, low)))
+        stop = int(round(self.percentile(sector, metric, high)))
+        if count <= 0 or stop <= start:
+            return range(start, stop)
+        if spacing == 'steps':
+            return range(start, stop, -(-(stop - start) // count))
+        values = self.values(sector, metric)
+        qs = low + (high - low) * np.arange(count) / count
+        thresholds = np.round(groupPercentiles(values, np.array([0, len(values)]), qs)[0]).astype(np.int64)
+        return sorted(set(int(t) for t in thresholds if start <= t < stop))
+
+    #Grid of a sector for the metrics gridMetrics (one threshold list per metric, in frame order) with
+    #at most maxFrames frames.  Each metric can use up to the width of its band in whole numbers; the
+    #budget is spread so every band is covered in as even a share as possible.
+    def budgetGrid(self, sector, gridMetrics, maxFrames, spacing='steps', low=34, high=68):
+        widths = [max(int(round(self.percentile(sector, m, high))) - int(round(self.percentile(sector, m, low))), 0) \
+                  for m in gridMetrics]
+        counts = allocateThresholds(widths, maxFrames)
+        return [self.bandThresholds(sector, m, c, spacing, low, high) for m, c in zip(gridMetrics, counts)]
+
+    def save(self, path, key):
+        temporary = path + ".tmp.npz"
+        saved = {'key': np.array(key), 'sectors': np.array(self.sectors, dtype=str), 'table': self.table}
+        for m in range(len(metrics)):
+            saved['values%d' % m] = self.sortedValues[m]
+            saved['offsets%d' % m] = self.offsets[m]
+        np.savez(temporary, **saved)
+        os.replace(temporary, path)
+
+#Number of thresholds for each metric so that their product, the frame count, is at most maxFrames.
+#widths[m] is the most thresholds metric m can use.  Thresholds are added one at a time to the metric
+#covering the smallest share of its width that still fits the budget.
+def allocateThresholds(widths, maxFrames):
+    counts = [min(w, 1) for w in widths]
+    frames = int(np.prod(counts))
+    while frames > 0:
+        fits = [m for m in range(len(widths)) if counts[m] < widths[m] and \
+                frames // counts[m] * (counts[m] + 1) <= maxFrames]
+        if not fits:
+            break
+        m = min(fits, key=lambda m: counts[m] / widths[m])
+        frames = frames // counts[m] * (counts[m] + 1)
+        counts[m] += 1
+    return counts
+
+#Loads a plan written by RangePlan.save, or returns None if there is none for this key
+def loadRangePlan(path, key):
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        if str(saved['key']) != key:
+            return None
+        return RangePlan(saved['sectors'].tolist(), [saved['values%d' % m] for m in range(len(metrics))], \
+                         [saved['offsets%d' % m] for m in range(len(metrics))], saved['table'])
+
+#Builds the plan of every sector from a frame with the sector in index level sectorLevel (the layout
+#of totalDF_ranges).  Missing values are left out per metric, like .dropna() in getNormal.
+def buildRangePlan(rangesDF, sectorLevel=1):
+    sectorCodes, sectors = pd.factorize(rangesDF.index.get_level_values(sectorLevel), sort=True)
+    sortedValues, offsets = [], []
+    table = np.empty((len(sectors), len(metrics), len(planPercentiles)))
+    for m, metric in enumerate(metrics):
+        values = rangesDF[metric].to_numpy()
+        present = ~np.isnan(values) & (sectorCodes >= 0)
+        values, codes = values[present], sectorCodes[present]
+        order = np.lexsort((values, codes))
+        sortedValues.append(values[order])
+        offsets.append(np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(sectors))))))
+        table[:, m, :] = groupPercentiles(sortedValues[m], offsets[m], planPercentiles)
+    return RangePlan(list(sectors), sortedValues, offsets, table)
+
+#Builds the plan from (sector, values) pairs given in order of sector name, values being the sector's
+#metrics (rows x metrics, NaN where missing), for sources read a piece at a time.  Each sector is
+#sorted as it arrives and its raw rows can then be dropped, so besides the plan itself (every
+#non-missing value, about rows x 7 numbers) only one sector's rows are held.  It equals buildRangePlan
+#of the same rows.
+def sectorsRangePlan(sectorValues):
+    sectors, rows = [], []
+    columns = [[] for m in metrics]
+    for sector, values in sectorValues:
+        sectors.append(sector)
+        table = np.empty((len(metrics), len(planPercentiles)))
+        for m in range(len(metrics)):
+            column = np.sort(values[:, m][~np.isnan(values[:, m])])
+            table[m] = groupPercentiles(column, np.array([0, len(column)]), planPercentiles)[0]
+            columns[m].append(column)
+        rows.append(table)
+    sortedValues, offsets = [], []
+    for m in range(len(metrics)):
+        offsets.append(np.concatenate(([0], np.cumsum([len(c) for c in columns[m]], dtype=np.int64))))
+        sortedValues.append(np.concatenate(columns[m]) if columns[m] else np.empty(0))
+        columns[m] = None
+    table = np.stack(rows) if rows else np.empty((0, len(metrics), len(planPercentiles)))
+    return RangePlan(sectors, sortedValues, offsets, table)
+
+#The saved plan for key, or a new plan built from rangesDF and saved under key
+def cachedRangePlan(path, key, rangesDF, sectorLevel=1):
+    plan = loadRangePlan(path, key)
+    if plan is None:
+        plan = buildRangePlan(rangesDF, sectorLevel)
+        plan.save(path, key)
+    return plan
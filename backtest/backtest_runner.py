@@ -0,0 +1,125 @@
+#Runs several sectors of the backtest at once, one process per sector.
+#Sectors are dispatched longest job first, so the slowest sector starts straight away and the
+#short ones fill the other cores around it; wall-clock time then approaches the slowest sector alone.
+import os
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from backtest_engine import SectorArrays, FrameStats, evaluateGrid, gridShape
+
+#Fields of SectorArrays that are placed in shared memory for frame shards
+sharedFields = ['values', 'returns', 'betas', 'valid']
+
+#Runs runSector(sector, *args) in a worker and returns how long it took
+def timedRun(runSector, sector, args):
+    start = time.time()
+    runSector(sector, *args)
+    return time.time() - start
+
+#Orders sectors by estimated cost, most expensive first
+def longestFirst(costs):
+    return sorted(costs, key=costs.get, reverse=True)
+
+#Forked workers share whatever the parent has loaded; other start methods would re-run the script
+def poolContext():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+#Runs every sector in costs (sector -> estimated cost) and returns sector -> seconds taken.
+#Workers are forked so they share the data already loaded by the backtest script; where fork is not
+#available, or processes is 1, the sectors simply run one after another in this process.
+#runSector must write its output under a name that includes the sector so workers never collide.
+def runSectorsParallel(runSector, costs, args=(), processes=None):
+    order = longestFirst(costs)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(order)))
+
+    timings = {}
+    if processes == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for s in order:
+            timings[s] = timedRun(runSector, s, args)
+            print(s, 'done in', round(timings[s], 1), 's')
+        return timings
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=poolContext()) as pool:
+        futures = {pool.submit(timedRun, runSector, s, args): s for s in order}
+        for future in as_completed(futures):
+            s = futures[future]
+            timings[s] = future.result()
+            print(s, 'done in', round(timings[s], 1), 's')
+    return timings
+
+#Copies a sector's arrays into shared memory.  Returns the blocks (the caller closes and unlinks them)
+#and a small picklable description that workers pass to attachArrays.
+def shareArrays(arrays):
+    blocks = []
+    spec = {'dates': arrays.dates, 'signs': arrays.signs}
+    for field in sharedFields:
+        data = getattr(arrays, field)
+        block = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[...] = data
+        blocks.append(block)
+        spec[field] = (block.name, data.shape, data.dtype.str)
+    return blocks, spec
+
+#Maps the shared blocks described by spec back into a SectorArrays without copying
+def attachArrays(spec):
+    blocks = []
+    fields = {}
+    for field in sharedFields:
+        name, shape, dtype = spec[field]
+        block = shared_memory.SharedMemory(name=name)
+        fields[field] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        blocks.append(block)
+    arrays = SectorArrays(fields['values'], fields['returns'], fields['betas'], fields['valid'], spec['dates'], signs=spec['signs'])
+    return blocks, arrays
+
+#Worker side of evaluateSharded: scores frame IDs first..last-1 of the grid of ranges.  With riskFree
+#and benchmark it also measures the shard's FrameStats and returns their columns.
+def evaluateShard(spec, ranges, first, last, riskFree=None, benchmark=None):
+    blocks, arrays = attachArrays(spec)
+    stats = FrameStats(last - first, riskFree, benchmark) if riskFree is not None else None
+    try:
+        meanReturn, meanBeta = evaluateGrid(arrays, ranges, frameRange=(first, last), stats=stats)
+    finally:
+        del arrays
+        for block in blocks:
+            block.close()
+    return first, meanReturn, meanBeta, stats.columns if stats is not None else None
+
+#evaluateGrid for one sector split into contiguous frame-ID shards over a process pool.
+#The sector's arrays are put in shared memory once instead of being pickled to every worker, and
+#the shards' results are written back into one pair of arrays.  Several shards per process keep
+#the cores busy when some parts of the grid are cheaper than others.  stats, a FrameStats of the
+#grid, is filled from the shards' stats in the same way.
+def evaluateSharded(arrays, ranges, processes=None, shardsPerProcess=4, stats=None):
+    if processes is None:
+        processes = os.cpu_count() or 1
+    nFrames = int(np.prod(gridShape(ranges)))
+    bounds = np.unique(np.linspace(0, nFrames, processes * shardsPerProcess + 1).astype(int))
+
+    meanReturn = np.empty(nFrames)
+    meanBeta = np.empty(nFrames)
+    measure = (stats.riskFree, stats.benchmark) if stats is not None else ()
+    blocks, spec = shareArrays(arrays)
+    try:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=poolContext()) as pool:
+            futures = [pool.submit(evaluateShard, spec, ranges, int(a), int(b), *measure) \
+                       for a, b in zip(bounds[:-1], bounds[1:])]
+            for future in as_completed(futures):
+                first, shardReturn, shardBeta, shardStats = future.result()
+                meanReturn[first:first+len(shardReturn)] = shardReturn
+                meanBeta[first:first+len(shardBeta)] = shardBeta
+                if shardStats is not None:
+                    for name, values in shardStats.items():
+                        stats.columns[name][first:first+len(values)] = values
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return meanReturn, meanBeta